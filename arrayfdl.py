@@ -0,0 +1,262 @@
+import numpy as np
+from treeclasses import *
+from graphstore import CompactGraph
+
+# A graph whose simulation state (positions, velocities, forces, charges
+# and the fixed mask) is kept in contiguous numpy arrays, so that a whole
+# step can be computed with batched array operations instead of one
+# Vector allocation per add. The Node objects are only written to when
+# sync is called. The edges may be given as a graphstore.CompactGraph,
+# whose index arrays are then used as they are.
+class ArrayGraph(object):
+    def __init__(self, nodes, edges, root=None):
+        self.nodes = list(nodes)
+        self.index = dict((node, i) for i, node in enumerate(self.nodes))
+        n = len(self.nodes)
+
+        self.pos      = np.zeros((n, 2))
+        self.velocity = np.zeros((n, 2))
+        self.force    = np.zeros((n, 2))
+        self.charge   = np.zeros(n)
+        self.fixed    = np.zeros(n, dtype=bool)
+        # a parallel.ForcePool evaluating the repulsive forces, if any
+        self.pool     = None
+
+        if isinstance(edges, CompactGraph):
+            self.src, self.dst = edges.src, edges.dst
+            if edges.nodes != self.nodes:
+                order = np.array([self.index[node] for node in edges.nodes], dtype=np.intp)
+                self.src, self.dst = order[self.src], order[self.dst]
+        else:
+            edges = list(edges)
+            self.src = np.array([self.index[e[0]] for e in edges], dtype=np.intp)
+            self.dst = np.array([self.index[e[1]] for e in edges], dtype=np.intp)
+
+        # spring constants and rest lengths, either shared by every edge or
+        # one per edge; a tree stiffens its springs by level, as
+        # update_hooke_forces_tree does
+        if root is None:
+            self.spring_k, self.spring_rest = 10.0, 60.0
+        else:
+            level = tree_levels(root)
+            node_level = np.array([level[node] for node in self.nodes], dtype=float)
+            edge_level = np.maximum(node_level[self.src], node_level[self.dst])
+            self.spring_k    = 10 * edge_level ** 2
+            self.spring_rest = 60.0 / (2 * edge_level)
+
+        self.load()
+
+    # an ArrayGraph with no Node objects behind it, for graphs that only
+    # exist as arrays (e.g. the coarse levels of a multilevel layout)
+    @classmethod
+    def from_arrays(cls, pos, charge, src, dst, spring_k=10.0, spring_rest=60.0):
+        graph = cls([], [])
+        n = len(charge)
+        graph.pos      = np.array(pos, dtype=float).reshape(n, 2)
+        graph.velocity = np.zeros((n, 2))
+        graph.force    = np.zeros((n, 2))
+        graph.charge   = np.array(charge, dtype=float)
+        graph.fixed    = np.zeros(n, dtype=bool)
+        graph.src = np.asarray(src, dtype=np.intp)
+        graph.dst = np.asarray(dst, dtype=np.intp)
+        graph.spring_k, graph.spring_rest = spring_k, spring_rest
+        return graph
+
+    def __len__(self):
+        return len(self.pos)
+
+    # read the simulation state of every node into the arrays
+    def load(self):
+        for i, node in enumerate(self.nodes):
+            self.load_node(i, node)
+
+    def load_node(self, i, node):
+        self.pos[i]      = tuple(node.pos)
+        self.velocity[i] = tuple(node.velocity)
+        self.force[i]    = tuple(node.force)
+        self.charge[i]   = node.charge
+        self.fixed[i]    = node.fixed
+
+    # write the array positions back to the free nodes. Fixed nodes are
+    # positioned by their callers (e.g. map_graph while dragging), so
+    # they are left alone
+    def sync(self, velocities=False):
+        pos = self.pos.astype(int).tolist()
+        for node, (x, y), fixed in zip(self.nodes, pos, self.fixed.tolist()):
+            if not fixed:
+                node.pos = Vector(x, y)
+        if velocities:
+            for node, (vx, vy) in zip(self.nodes, self.velocity.tolist()):
+                node.velocity = Vector(vx, vy)
+
+    # hold a node at pos, or at its current Node.pos, as run_simulation
+    # does for a node being dragged
+    def pin(self, node, pos=None):
+        i = self.index[node]
+        self.pos[i]      = tuple(node.pos if pos is None else pos)
+        self.velocity[i] = 0
+        self.force[i]    = 0
+        self.fixed[i]    = True
+
+    def unpin(self, node):
+        self.fixed[self.index[node]] = False
+
+
+# map each node of a tree (or TreeView) to its level, counting the root as
+# level 0
+def tree_levels(root):
+    return dict(root.walk() if isinstance(root, TreeView) else walk(root))
+
+# round half away from zero, as the builtin round does
+def round_half_away(a):
+    return np.sign(a) * np.floor(np.abs(a) + .5)
+
+# add the rows of vals into out at the given indices (repeats accumulate)
+def scatter_add(out, idx, vals):
+    n = len(out)
+    out[:, 0] += np.bincount(idx, weights=vals[:, 0], minlength=n)
+    out[:, 1] += np.bincount(idx, weights=vals[:, 1], minlength=n)
+
+
+# coulomb's law for arrays of distance vectors and charge products;
+# zero-length distances contribute nothing
+def coulomb(dist_vects, k, charges):
+    dist = np.sqrt((dist_vects ** 2).sum(axis=-1))
+    scale = k * charges / ((dist + 1) ** 2) / np.where(dist == 0, 1, dist)
+    return dist_vects * scale[..., np.newaxis]
+
+# the coulomb force on each of the given rows from every node. Like
+# fdl.net_coulomb, each coincident node (the row itself included) adds a
+# constant (100, 100) push
+def net_coulomb(graph, rows, k=100):
+    pos, charge = graph.pos, graph.charge
+    dist_vects = pos[rows, np.newaxis, :] - pos[np.newaxis, :, :]
+    charges    = charge[rows, np.newaxis] * charge[np.newaxis, :]
+    force      = coulomb(dist_vects, k, charges).sum(axis=1)
+    coincident = (dist_vects == 0).all(axis=2).sum(axis=1)
+    force += 100 * coincident[:, np.newaxis]
+    return force
+
+# the coulomb forces on the given rows, computed block_size rows at a
+# time so the pairwise arrays stay a bounded size
+def coulomb_rows(graph, rows, k=100, block_size=256):
+    force = np.empty((len(rows), 2))
+    for start in xrange(0, len(rows), block_size):
+        force[start:start + block_size] = net_coulomb(graph, rows[start:start + block_size], k)
+    return force
+
+# update the electrical forces of the free nodes, on the graph's worker
+# pool if it has one
+def update_coulomb_forces(graph, k=100):
+    if graph.pool is not None:
+        graph.pool.update_coulomb_forces(k)
+        return
+    free = np.flatnonzero(~graph.fixed)
+    graph.force[free] += coulomb_rows(graph, free, k)
+
+# update the hooke forces along every edge of the graph, block_size
+# edges at a time
+def update_hooke_forces(graph, block_size=1 << 18):
+    spring_k    = np.reshape(graph.spring_k, (-1, 1))
+    spring_rest = np.reshape(graph.spring_rest, (-1, 1))
+    for start in xrange(0, len(graph.src), block_size):
+        block = slice(start, start + block_size)
+        src, dst = graph.src[block], graph.dst[block]
+        dist_vects = graph.pos[src] - graph.pos[dst]
+        dist = np.sqrt((dist_vects ** 2).sum(axis=1))
+        normed = dist_vects / np.where(dist == 0, 1, dist)[:, np.newaxis]
+        k = spring_k[block] if len(spring_k) > 1 else spring_k
+        r = spring_rest[block] if len(spring_rest) > 1 else spring_rest
+        f = -k * (dist_vects - r * normed)
+        scatter_add(graph.force, src, f)
+        scatter_add(graph.force, dst, -f)
+
+def update_forces(graph):
+    update_coulomb_forces(graph)
+    update_hooke_forces(graph)
+
+def update_velocs(graph, dt, friction=.96):
+    free = ~graph.fixed
+    graph.velocity[free] += graph.force[free] * dt
+    graph.velocity[free] *= friction
+
+# positions are rounded to whole pixels, as in fdl.update_posns
+def update_posns(graph, dt):
+    free = ~graph.fixed
+    graph.pos[free] = round_half_away(graph.pos[free] + dt * graph.velocity[free])
+    graph.force[free] = 0
+
+# evolve the state of an ArrayGraph with time-step dt
+def update_graph(graph, dt):
+    update_forces(graph)
+    update_velocs(graph, dt)
+    update_posns(graph, dt)
+
+
+# An integrator whose time-step and damping follow the progress of the
+# layout, in the manner of adaptive cooling. The energy of the layout is
+# taken to be the sum of the squared forces on the free nodes. After
+# patience steps in a row that lower it, dt grows by 1 / step_ratio (up to
+# max_dt) and the friction relaxes by 1 / damping_ratio back towards
+# friction; a step that raises it shrinks dt by step_ratio (down to
+# min_dt) and the friction by damping_ratio (down to min_friction). dt
+# never falls below the starting time-step unless min_dt says so: since
+# positions are whole pixels, a much smaller step freezes the layout
+# before it settles. With per_node set, each node also keeps its own step
+# scale, which is halved (down to min_scale) whenever the node's velocity
+# reverses direction and recovers while it moves steadily, so that
+# oscillating nodes calm down without slowing the rest. update_forces is
+# the force function to use, e.g. flatbh.update_forces_bh
+class AdaptiveStepper(object):
+    def __init__(self, graph, dt, min_dt=None, max_dt=None, step_ratio=.9, patience=5,
+                 friction=.96, min_friction=.9, damping_ratio=.99, per_node=True,
+                 min_scale=.25, update_forces=update_forces):
+        self.graph = graph
+        self.dt = dt
+        self.min_dt = min_dt if min_dt is not None else dt
+        self.max_dt = max_dt if max_dt is not None else dt * 10.0
+        self.step_ratio, self.patience = step_ratio, patience
+        self.base_friction = self.friction = friction
+        self.min_friction, self.damping_ratio = min_friction, damping_ratio
+        self.per_node, self.min_scale = per_node, min_scale
+        self.update_forces = update_forces
+        self.node_scale = np.ones(len(graph))
+        self.energy = np.inf
+        self.progress = 0
+        self.steps = 0
+
+    # adjust dt and damping for the energy of the current step
+    def cool(self, energy):
+        if energy < self.energy:
+            self.progress += 1
+            if self.progress >= self.patience:
+                self.progress = 0
+                self.dt = min(self.max_dt, self.dt / self.step_ratio)
+                self.friction = min(self.base_friction, self.friction / self.damping_ratio)
+        else:
+            self.progress = 0
+            self.dt = max(self.min_dt, self.dt * self.step_ratio)
+            self.friction = max(self.min_friction, self.friction * self.damping_ratio)
+        self.energy = energy
+
+    # evolve the graph by one adaptive step
+    def step(self):
+        graph = self.graph
+        self.update_forces(graph)
+        free = ~graph.fixed
+        self.cool((graph.force[free] ** 2).sum())
+
+        dt = self.dt * self.node_scale[free, np.newaxis]
+        old_velocity = graph.velocity[free]
+        velocity = (old_velocity + graph.force[free] * dt) * self.friction
+        if self.per_node:
+            reversed = (old_velocity * velocity).sum(axis=1) < 0
+            scale = self.node_scale[free]
+            scale[reversed] *= .5
+            scale[~reversed] *= 1.2
+            self.node_scale[free] = np.clip(scale, self.min_scale, 1)
+
+        graph.velocity[free] = velocity
+        graph.pos[free] = round_half_away(graph.pos[free] + dt * velocity)
+        graph.force[free] = 0
+        self.steps += 1
@@ -1,9 +1,14 @@
 from fdl import *
+import graphstore
+from treelayout import seed_tree
 
-usage = 'Enter desired window side-length followed by "bin" (binary tree) or "com" (complete graph) followed by a positive integer.'
+usage = 'Enter "bin" (binary tree) or "com" (complete graph) followed by a positive integer, optionally followed by "numpy", "parallel" or "threaded" to use the array engine and, for a tree, "tidy" or "radial" to start from a tree layout instead of random positions.'
 advice = "Try clicking and dragging the vertices of the graph."
 max_dim = 500
 
+engine = sys.argv[3] if len(sys.argv) > 3 else 'python'
+seed = sys.argv[4] if len(sys.argv) > 4 else None
+
 if len(sys.argv) < 3:
 	print usage
 
@@ -12,18 +17,22 @@ elif sys.argv[1] == 'bin':
     n_root = binary_tree(int(sys.argv[2]))
     edges = get_edges(n_root)
     alln = all_nodes(n_root)
-    initialize(alln, max_dim, 300)
+    if seed in ('tidy', 'radial'):
+        seed_tree(n_root, max_dim, 300, seed == 'radial')
+    else:
+        initialize(alln, max_dim, 300)
     
     print advice
-    run_simulation(alln, edges, 500, 500, .01, True, n_root)
+    run_simulation(alln, edges, 500, 500, .01, True, n_root, engine)
 
 # an example for a general graph
 elif sys.argv[1] == 'com':
-    g_nodes, g_edges = complete_graph(int(sys.argv[2]))
+    g_edges = graphstore.complete_graph(int(sys.argv[2]))
+    g_nodes = g_edges.nodes
     initialize(g_nodes, max_dim, 300)
 
     print advice
-    run_simulation(g_nodes, g_edges, 500, 500, .01)
+    run_simulation(g_nodes, g_edges, 500, 500, .01, engine=engine)
 
 else:
 	print usage
\ No newline at end of file
@@ -1,79 +1,64 @@
 from treeclasses import *
 from fdl import *
-import cPickle
-import threading
-import Queue
-import urllib2
+from flatbh import nodes_to_flat_bh_tree, update_flat_bh_tree
+from fetcher import Fetcher, rate_limited, download_urls
+from httpcache import ResponseCache
+from graphstore import GraphBuilder
+from graphfile import save_graph
+from framewriter import FrameWriter
+from layout import max_displacement
 import json
+import threading
+import numpy as np
 import pygame
 
-# based on an implementation from 
-# http://www.artfulcode.net/articles/multi-threading-python/
-# A class to facilitate multithreaded downloading of web pages
-class URLThread(threading.Thread):
-    """A class to download web pages in parallel threads"""
-    def __init__(self, url, label):
-        self.url = url
-        self.label = label
-        self.result = None
-        threading.Thread.__init__(self)
-    def run(self):
-        try:
-            page = urllib2.urlopen(self.url)
-            contents = page.read()
-            page.close()
-            self.result = contents
-        except IOError:
-            print "Could not open url: {0}".format(self.url)
+# the codes the Graph API gives its errors when a user or application
+# has made too many requests
+GRAPH_RATE_LIMIT_CODES = (4, 17, 32, 613)
 
-
-# A function to download a dictionary of labels to urls in 
-# multiple threads, returning a dictionary that maps from the
-# same labels to the contents of those urls
-def download_urls(url_dict, max_threads):
-    def producer(q, url_dict):
-        for label, url in url_dict.iteritems():
-            thread = URLThread(url, label)
-            thread.start()
-            q.put(thread, True)
-
-    finished = {}
-
-    def consumer(q, total_files):
-        while len(finished) < total_files:
-            thread = q.get(True)
-            thread.join()
-            # Having results equal to None will cause a lot of trouble
-            # when we use this for the purpose of scraping mutual friend
-            # relationships
-            if thread.result:
-                finished[thread.label] = thread.result
-
-    q = Queue.Queue(max_threads)
-
-    prod_thread = threading.Thread(target=producer, args=(q, url_dict))
-    cons_thread = threading.Thread(target=consumer, args=(q, len(url_dict)))
-    prod_thread.start()
-    cons_thread.start()
-    prod_thread.join()
-    cons_thread.join()
-    return finished
-
-# An interface for the Open-Graph of the user with the given id_number
+# whether a Graph API response says to slow down. Besides the usual 429
+# and 503, the Graph API reports its limits as errors with the codes above
+def graph_rate_limited(status, body):
+    if rate_limited(status, body):
+        return True
+    if status in (400, 403):
+        try:
+            return json.loads(body)['error']['code'] in GRAPH_RATE_LIMIT_CODES
+        except (ValueError, KeyError, TypeError):
+            pass
+    return False
+
+# An interface for the Open-Graph of the user with the given id_number.
+# Requests go through a fetcher.Fetcher of concurrency workers; base_url
+# may point at a local stand-in for the Graph API. With a cache_path, the
+# responses are kept in an httpcache.ResponseCache there, so that later
+# sessions only download what is missing, stale or changed
 class Facebook(object):
-    def __init__(self, id_number, access_token):
+    def __init__(self, id_number, access_token, concurrency=16,
+                 base_url='https://graph.facebook.com', cache_path=None, ttl=24 * 60 * 60):
         self.id = id_number
         self.access_token = access_token
+        self.base_url = base_url
+        self.fetcher = Fetcher(concurrency, throttled=graph_rate_limited)
+        self.cache = ResponseCache(cache_path, ttl) if cache_path else None
+
+    def friends_url(self):
+        return ('{0}/{1}/friends?access_token={2}'
+                .format(self.base_url, self.id, self.access_token))
+
+    # the url of the list of the user's mutual friends with the user with
+    # the given id number, friend_id
+    def mutual_friends_url(self, friend_id):
+        return ('{0}/{1}/mutualfriends/{2}?access_token={3}'
+                .format(self.base_url, self.id, friend_id, self.access_token))
 
     # return the friends list of the user as a list of dictionaries
-    def get_friends(self):
+    def get_friends(self, max_age=None):
         try:
             friends = self.friends
         except AttributeError:
-            url  = ('https://graph.facebook.com/{0}/friends?access_token={1}'
-                    .format(self.id, self.access_token))
-            page = urllib2.urlopen(url)
-            friends = json.load(page)['data']
+            page = self.fetcher.get(self.friends_url(), self.cache, max_age)
+            friends = json.loads(page)['data']
             # memoize the result as an attribute
             self.friends = friends
         return friends
@@ -81,11 +66,9 @@ class Facebook(object):
     # returns a list of the user's mutual friends with the user with
     # the given id number, friend_id
     def mutual_friends(self, friend_id):
-        url = ('https://graph.facebook.com/{0}/'
-               'mutualfriends/{1}?access_token={2}'
-               .format(self.id, friend_id, self.access_token))
         try:
-            mut_friends = json.load(urllib2.urlopen(url))['data']
+            page = self.fetcher.get(self.mutual_friends_url(friend_id), self.cache)
+            mut_friends = json.loads(page)['data']
         except IOError:
             print ("Mutual friend scraping failed for IDs {0} and {1}."
                    .format(self.id, friend_id))
@@ -93,115 +76,240 @@ class Facebook(object):
 
         return mut_friends
 
+    # yield (friend id, list of mutual friends) pairs as the lists are
+    # downloaded, for the given friend ids or all of them. Friends whose
+    # list could not be downloaded are left out, and their ids are in
+    # self.fetcher.failures afterwards. Cached lists younger than max_age
+    # seconds are used as they are
+    def iter_mutual_friend_lists(self, ids=None, max_age=None):
+        if ids is None:
+            ids = (f['id'] for f in self.get_friends())
+        requests = ((id_num, self.mutual_friends_url(id_num)) for id_num in ids)
+        for id_num, page in self.fetcher.fetch(requests, self.cache, max_age):
+            yield id_num, json.loads(page)['data']
+
     def all_mutual_friend_lists(self):
-        friends = self.get_friends()
         try:
             mut_friend_dict = self.mutual_friend_dict
         except AttributeError:
-            # build a dictionary that maps from a friend's id number to
-            # the url of the list of the user's mutual friends with them
-            url_dict = {}
-            base_url = ('https://graph.facebook.com/{0}/'
-                        'mutualfriends/{1}?access_token={2}')
-
-            url_dict = {f['id']: base_url.format(self.id, f.id, self.access_token)
-                        for f in friends}
-
-            mut_friend_dict = download_urls(url_dict, 3)
-            mut_friend_dict = {i: json.loads(page)['data'] 
-                               for i, page in mut_friend_id.iteritems()}
-
+            mut_friend_dict = dict(self.iter_mutual_friend_lists())
             # memoize the dictionary as an attribute
             self.mutual_friend_dict = mut_friend_dict
 
         return mut_friend_dict
 
-    # generate a list of edges, where each node is a friend of the user,
-    # and each edge represents a friendship between two users
+    # the mutual friend list of a friend as it was last downloaded, however
+    # old, or an empty list
+    def cached_mutual_friends(self, friend_id):
+        entry = self.cache.lookup(self.mutual_friends_url(friend_id)) if self.cache else None
+        return json.loads(entry.body)['data'] if entry is not None else []
+
+    # bring the friends list and the mutual friend lists up to date with as
+    # few downloads as possible. The friends list is always downloaded
+    # again. A friend added since the last scrape needs a new list, and so
+    # does every friend on a list of a friend added or removed, since they
+    # gained or lost that mutual friend. The other lists are taken from the
+    # cache even if they are stale; refresh_age gives the age past which
+    # they are revalidated with the server anyway (which costs a request,
+    # but no download while they are unchanged). Returns the sets of ids of
+    # the friends added and removed
+    def refresh(self, refresh_age=None):
+        try:
+            old_friends = self.friends
+        except AttributeError:
+            entry = self.cache.lookup(self.friends_url()) if self.cache else None
+            old_friends = json.loads(entry.body)['data'] if entry is not None else []
+        for attr in ('friends', 'mutual_friend_dict', 'graph', 'builder'):
+            self.__dict__.pop(attr, None)
+
+        friends = self.get_friends(max_age=0)
+        old_ids = set(f['id'] for f in old_friends)
+        ids = set(f['id'] for f in friends)
+        added, removed = ids - old_ids, old_ids - ids
+
+        changed = set()
+        for id_num in removed:
+            changed.update(f['id'] for f in self.cached_mutual_friends(id_num))
+        mut_friend_dict = {}
+        for id_num, mut_friends in self.iter_mutual_friend_lists(added, max_age=0):
+            mut_friend_dict[id_num] = mut_friends
+            changed.update(f['id'] for f in mut_friends)
+        changed = (changed & ids) - added
+        mut_friend_dict.update(self.iter_mutual_friend_lists(changed, max_age=0))
+
+        rest = ids - added - changed
+        max_age = float('inf') if refresh_age is None else refresh_age
+        mut_friend_dict.update(self.iter_mutual_friend_lists(rest, max_age))
+        self.mutual_friend_dict = mut_friend_dict
+        return added, removed
+
+    # the friends of the user as a dictionary from id numbers to Node
+    # objects
+    def friend_nodes(self):
+        res = {}
+        for friend in self.get_friends():
+            friend_node = Node()
+            id_num = friend['id']
+            friend_node.name = friend['name']
+            friend_node.id = id_num
+            res[id_num] = friend_node
+        return res
+
+    # build the friend graph into a graphstore.GraphBuilder, adding each
+    # mutual friend list's edges as the list arrives. With background set
+    # this happens in another thread and the builder is returned at once,
+    # so that a layout can start on the edges found so far while the rest
+    # download; builder.finished is set once the graph is complete. The
+    # graph is then memoized as self.graph, as friends_graph does. The
+    # builder is kept as self.builder, so a call made while a build is
+    # still going on (say, after a layout that ended early) shares it
+    # rather than starting the download again; one that fails is dropped
+    def build_friends_graph(self, background=False):
+        builder = getattr(self, 'builder', None)
+        if builder is not None:
+            if not background:
+                builder.finished.wait()
+            return builder
+
+        friend_nodes = self.friend_nodes()
+        ids = friend_nodes.keys()
+        index = dict((id_num, i) for i, id_num in enumerate(ids))
+        builder = self.builder = GraphBuilder([friend_nodes[id_num] for id_num in ids])
+
+        def fill():
+            try:
+                try:
+                    lists = self.mutual_friend_dict.iteritems()
+                except AttributeError:
+                    lists = self.iter_mutual_friend_lists()
+                mut_friend_dict = {}
+                for id_num, mut_friends in lists:
+                    mut_friend_dict[id_num] = mut_friends
+                    builder.add_edges(index[id_num],
+                                      [index[f['id']] for f in mut_friends if f['id'] in index])
+                self.mutual_friend_dict = mut_friend_dict
+                self.graph = friend_nodes, builder.graph()
+            except:
+                self.builder = None
+                raise
+            finally:
+                builder.finish()
+
+        if background:
+            thread = threading.Thread(target=fill)
+            thread.daemon = True
+            thread.start()
+        else:
+            fill()
+        return builder
+
+    # generate the graph of the user's friends, where each node is a friend
+    # of the user, and each edge represents a friendship between two users.
+    # Returns a dictionary from id numbers to nodes and the edges as a
+    # graphstore.CompactGraph
     def friends_graph(self):
-        # build a dictionary of Node objects from a list of friends for
-        # use in the graph
-        def friends_to_node_dict(friends):
-            res = {}
-            for friend in friends:
-                friend_node = Node()
-                id_num = friend['id']
-                friend_node.name = friend['name']
-                friend_node.id = id_num
-                res[id_num] = friend_node
-            return res
-
-        friends = self.get_friends()
-        friend_nodes = friends_to_node_dict(friends)
-        edges = set()
-
-        mutual_friend_dict = self.all_mutual_friend_lists()
-
-        for id_num, friend_node in friend_nodes.iteritems():
-            mut_friend_id_list = [f['id'] for f in mutual_friend_dict[id_num]]
-
-            for mut_friend_id in mut_friend_id_list:
-                edge = (a, b) = (friend_node, friend_nodes[mut_friend_id])
-                if (b, a) not in edges:
-                    edges.add(edge)
-
-        graph = friend_nodes, edges
-        # memoize
-        self.graph = graph
-        return graph
-
-    # saves the graph structure of your social network to a file
-    # to prevent having to re-scrape Facebook
-    def pickle_friend_graph(self, out_file_path):
+        self.build_friends_graph()
+        return self.graph
+
+    # saves the graph structure of your social network to a graph file
+    # (see graphfile) to prevent having to re-scrape Facebook, along with
+    # the current layout if layout is set
+    def save_friend_graph(self, out_file_path, layout=False):
         try:
             graph = self.graph
         except AttributeError:
             graph = self.friends_graph()
-        with open(out_file_path, 'w') as out_file:
-            cPickle.dump(graph, out_file)
+        friend_nodes, edges = graph
+        save_graph(out_file_path, edges.nodes, edges, layout, {'user': self.id})
 
-def update_graph_bh(bh_root, allnodes, edges, dt):
-    update_forces_bh(bh_root, allnodes, edges)
+    # the old name of save_friend_graph, kept for existing callers. The
+    # file is a graph file now rather than a pickle
+    def pickle_friend_graph(self, out_file_path):
+        self.save_friend_graph(out_file_path)
+
+# returns the number of interactions the Barnes-Hut step evaluated
+def update_graph_bh(bh_root, allnodes, edges, dt, theta=.25):
+    interactions = update_forces_bh(bh_root, allnodes, edges, theta)
     update_velocs(allnodes, dt)
     update_posns(allnodes, dt)
+    return interactions
 
 # draws the screen to reflect the current state of the graph
-def update_screen_bh(screen, bh_root, allnodes, edges, width, height, dt):
-    update_graph_bh(bh_root, allnodes, edges, dt)
+def update_screen_bh(screen, bh_root, allnodes, edges, width, height, dt, theta=.25,
+                     renderer=None):
+    interactions = update_graph_bh(bh_root, allnodes, edges, dt, theta)
     auto_scale(allnodes, width, height)
-    draw_edges(screen, edges)
-    for node in allnodes:
-        pygame.draw.circle(screen, (255, 255, 255), (int(node.screen_pos.x), int(node.screen_pos.y)), 3)
-
-
-def run_fb_simulation(facebook, mode, width, height, dt, out_directory):
+    (renderer or Renderer(screen, 3)).draw(allnodes, edges)
+    return interactions
+
+
+# theta trades the accuracy of the Barnes-Hut approximation for speed;
+# the number of interactions evaluated each step is shown in the caption.
+# With incremental set, the Barnes-Hut tree is carried over between
+# frames instead of being rebuilt every step. If the friend graph has not
+# been built yet, the layout starts straight away and each frame takes in
+# the edges that have been found since the last. In save mode the frames
+# go to a framewriter.FrameWriter, which encodes every stride-th one as a
+# PNG in out_directory on workers threads (and copies it to raw_path, if
+# given) while the layout carries on. The run ends once max_frames frames
+# are saved or, with disp_tol, once the whole graph is in and no node
+# moves more than disp_tol in a step
+def run_fb_simulation(facebook, mode, width, height, dt, out_directory, theta=.25, incremental=False,
+                      stride=1, max_frames=None, disp_tol=None, raw_path=None, workers=2):
     try:
-        nodes, edges = facebook.graph
+        friend_nodes, graph = facebook.graph
+        nodes, edges, builder = friend_nodes.values(), list(graph), None
     except AttributeError:
-        nodes, edges = facebook.friends_graph()
+        builder = facebook.build_friends_graph(background=True)
+        nodes, edges = builder.nodes, []
 
     initialize(nodes, width, 100)
     screen = pygame.display.set_mode((int(width * 1.4), int(height * 1.4)))
-    i = 0
+    renderer = Renderer(screen, 3)
+    bh_root = None
+    writer = None
+    old_pos = None
 
     if mode == 'live':
-        def update_image():
-            pygame.display.update
         pygame.init()
     elif mode == 'save':
-        def update_image():
-            pygame.image.save(screen, '{0}/pic{1}.png'.format(out_directory, i))
-
-    while True:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-        screen.fill((0,0,0))
-        bh_root = nodes_to_bh_tree(nodes)
-        update_screen_bh(screen, bh_root, nodes, edges, width, height, dt)
-        update_image()
-        i += 1
+        writer = FrameWriter(out_directory, workers=workers, stride=stride,
+                             max_frames=max_frames, raw_path=raw_path)
+
+    try:
+        while True:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    sys.exit()
+            screen.fill((0,0,0))
+            if builder is not None:
+                finished = builder.finished.is_set()
+                edges.extend(builder.edge_tuples(len(edges)))
+                if finished:
+                    builder = None
+            if incremental and bh_root is not None:
+                update_flat_bh_tree(bh_root)
+            else:
+                bh_root = nodes_to_flat_bh_tree(nodes, .1 if incremental else 0)
+            interactions = update_screen_bh(screen, bh_root, nodes, edges, width, height, dt, theta,
+                                            renderer)
+            pygame.display.set_caption('{0} interactions'.format(interactions))
+            if writer is None:
+                pygame.display.update()
+                continue
+
+            writer.add(screen)
+            if writer.done():
+                break
+            if disp_tol is not None and builder is None:
+                pos = np.array([tuple(node.pos) for node in nodes], dtype=float)
+                if old_pos is not None and max_displacement(old_pos, pos) < disp_tol:
+                    break
+                old_pos = pos
+    finally:
+        if writer is not None:
+            writer.close()
 
 
 if __name__ == "main":
@@ -1,59 +1,102 @@
 import pygame, sys
+import numpy as np
 from treeclasses import *
 from random import random, randint
 from copy import deepcopy
+import arrayfdl
+import parallel
+from flatbh import FlatBHTree
+from graphstore import CompactGraph
+from render import Renderer, screen_points
+from spatialgrid import SpatialGrid
+from simthread import SimulationThread
 
-# calculate coulomb's law force for the given parameters
+# calculate coulomb's law force for the given parameters. This and hooke
+# are evaluated for every pair or edge each step, so they build their
+# result directly instead of through intermediate Vectors
 def coulomb(dist_vect, k, q1, q2):
-    return (k * q1 * q2 / ((dist_vect.length()+1) ** 2)) * dist_vect.normed()
+    length = dist_vect.length()
+    scale  = k * q1 * q2 / ((length + 1) ** 2)
+    try:
+        return Vector(dist_vect.x / length * scale, dist_vect.y / length * scale)
+    except ZeroDivisionError:
+        return Vector(0 * scale, 0 * scale)
 
 # calculate the hooke's law force for the given parameters
 def hooke(dist_vect, k, r):
-    rest_vect = r * dist_vect.normed()
-    return -k * (dist_vect - rest_vect)
+    length = dist_vect.length()
+    try:
+        normed_x, normed_y = dist_vect.x / length, dist_vect.y / length
+    except ZeroDivisionError:
+        normed_x, normed_y = 0, 0
+    return Vector((dist_vect.x - normed_x * r) * -k, (dist_vect.y - normed_y * r) * -k)
 
-def net_bh_force(body, bh_root):
-    force = Vector(0, 0)
-    other_body = bh_root.body
-    dist_vect  = body.pos - bh_root.com
-    if other_body is body or dist_vect == Vector(0, 0):
-        pass
-    # if the other node is a leaf, calculate the force between the two bodies
-    elif other_body:
-        force += coulomb(dist_vect, 100, body.charge, other_body.charge)
-    # otherwise we'll decide whether or not to approximate
-    else:
-        ratio = bh_root.halfwidth / dist_vect.length()
-        if ratio < .25:
-            force += coulomb(dist_vect, 100, body.charge, bh_root.charge)
+# yield the (distance vector, charge) pair of each interaction the
+# Barnes-Hut approximation evaluates for body. A cell is approximated by
+# its total charge at its centre of mass once its half-width is less than
+# theta times its distance from the body
+def bh_interactions(body, bh_root, theta=.25):
+    stack = [bh_root]
+    while stack:
+        tree = stack.pop()
+        other_body = tree.body
+        dist_vect  = body.pos - tree.com
+        if other_body is body or dist_vect == Vector(0, 0):
+            pass
+        # if the other node is a leaf, calculate the force between the two bodies
+        elif other_body:
+            yield dist_vect, other_body.charge
+        # otherwise we'll decide whether or not to approximate
         else:
-            for child in bh_root.nodes.itervalues():
-                force += net_bh_force(body, child)
+            ratio = tree.halfwidth / dist_vect.length()
+            if ratio < theta:
+                yield dist_vect, tree.charge
+            else:
+                stack.extend(tree.nodes.itervalues())
+
+def net_bh_force(body, bh_root, theta=.25, k=100):
+    force = Vector(0, 0)
+    for dist_vect, charge in bh_interactions(body, bh_root, theta):
+        force += coulomb(dist_vect, k, body.charge, charge)
     return force
 
-def update_forces_bh(bh_root, allnodes, edges):
-    for node in allnodes:
-        node.force += net_bh_force(node, bh_root)
+# bh_root may be a BHTree or a FlatBHTree. Returns the number of
+# interactions evaluated
+def update_forces_bh(bh_root, allnodes, edges, theta=.25, k=100):
+    if isinstance(bh_root, FlatBHTree):
+        forces = bh_root.forces(k, theta)
+        for node, (fx, fy) in zip(bh_root.nodes, forces.tolist()):
+            node.force += Vector(fx, fy)
+        interactions = bh_root.interactions
+    else:
+        interactions = 0
+        for node in allnodes:
+            for dist_vect, charge in bh_interactions(node, bh_root, theta):
+                node.force += coulomb(dist_vect, k, node.charge, charge)
+                interactions += 1
     update_hooke_forces(edges)
+    return interactions
 
 
 # update the hooke forces between each connected node in a graph
-def update_hooke_forces(edges):
+def update_hooke_forces(edges, k=10, r=60):
     for edge in edges:
         dist_vect = edge[0].pos - edge[1].pos
-        f = hooke(dist_vect, 10, 60)
+        f = hooke(dist_vect, k, r)
         edge[0].force += f
         edge[1].force -= f
 
 # update the hooke forces between each connected node in a tree,
-# increasing the force by level
+# increasing the force by level. root may be a TreeView, in which case only
+# the edges of the view are used
 def update_hooke_forces_tree(root, level):
-    for child in root.children:
-        dist_vect = child.pos - root.pos
-        f = hooke(dist_vect, 10 * (level ** 2), 60.0/(2 *level))
-        child.force += f
-        root.force  -= f
-        update_hooke_forces_tree(child, level + 1)
+    edges = root.walk_edges() if isinstance(root, TreeView) else walk_edges(root)
+    for parent, child, depth in edges:
+        edge_level = level + depth - 1
+        dist_vect = child.pos - parent.pos
+        f = hooke(dist_vect, 10 * (edge_level ** 2), 60.0/(2 * edge_level))
+        child.force  += f
+        parent.force -= f
 
 
 # calculate the net electrical force on a node
@@ -62,7 +105,8 @@ def net_coulomb(base, nodes):
     for node in nodes:
         dist_vect = base.pos - node.pos
         if dist_vect.length() == 0:
-            force += Vector(100, 100)
+            force.x += 100
+            force.y += 100
         else:
             force += coulomb(dist_vect, 100, base.charge, node.charge)
     return force
@@ -85,9 +129,9 @@ def update_forces(allnodes, edges, is_tree=False, root=None):
 def update_posns(allnodes, dt):
     for node in allnodes:
         if not node.fixed:
-            new_pos    = node.pos + (dt * node.velocity)
-            node.pos   = Vector(int(round(new_pos.x)), int(round(new_pos.y)))
-            node.force = Vector(0,0)
+            node.pos = Vector(int(round(node.pos.x + node.velocity.x * dt)),
+                              int(round(node.pos.y + node.velocity.y * dt)))
+            node.force.x = node.force.y = 0
 
 # update all the velocities of each node in a graph
 def update_velocs(allnodes, dt):
@@ -97,8 +141,13 @@ def update_velocs(allnodes, dt):
             node.velocity += node.force * dt
             node.velocity *= friction
 
-# evolve the state of a graph with time-step dt
-def update_graph(allnodes, edges, dt, is_tree=False, root=None):
+# evolve the state of a graph with time-step dt. If an ArrayGraph is
+# given as state, the array engine is stepped instead and the nodes are
+# left untouched until state.sync() is called
+def update_graph(allnodes, edges, dt, is_tree=False, root=None, state=None):
+    if state is not None:
+        arrayfdl.update_graph(state, dt)
+        return
     update_forces(allnodes, edges, is_tree, root)
     update_velocs(allnodes, dt)
     update_posns(allnodes, dt)
@@ -149,48 +198,98 @@ def auto_scale(allnodes, width, height):
 
     map_graph(allnodes, x_scale, y_scale, x_shift, y_shift)
 
-def draw_edges(screen, edges):
-    for edge in edges:
-        pygame.draw.line(screen, (0, 0, 255), tuple(edge[0].screen_pos), tuple(edge[1].screen_pos))
+# auto_scale for an (n, 2) array of positions: returns their screen
+# points, and the x_scale, y_scale, x_shift and y_shift that map to them
+def scale_points(pos, width, height):
+    low, high = pos.min(axis=0), pos.max(axis=0)
+    # a graph with no extent in some direction is left unscaled in it
+    scale = np.array([width, height], dtype=float) / np.where(high > low, high - low, 1)
+    shift = 100 - low * scale
+    return pos * scale + shift, (scale[0], scale[1], shift[0], shift[1])
 
-def draw_nodes(nodes, screen, radius):
-    for node in nodes:
-        pygame.draw.circle(screen, 
-                           (255, 255, 255), 
-                           (int(node.screen_pos.x), int(node.screen_pos.y)), 
-                           radius)
-
-# updates the screen for a  graph
-def update_screen(screen, allnodes, edges, width, height, dt, is_tree=False, root=None):
-    update_graph(allnodes, edges, dt, is_tree, root)
+# edges and nodes are drawn in batches by a render.Renderer, which also
+# culls what is off the screen; pass one in to keep its state (and its
+# level of detail settings) between frames
+def draw_edges(screen, edges, renderer=None):
+    (renderer or Renderer(screen)).draw_edges(edges)
+
+def draw_nodes(nodes, screen, radius, renderer=None):
+    (renderer or Renderer(screen, radius)).draw_nodes(nodes)
+
+# updates the screen for a  graph. Returns a spatialgrid.SpatialGrid of
+# the nodes' new screen positions, for get_clicked_node
+def update_screen(screen, allnodes, edges, width, height, dt, is_tree=False, root=None, state=None,
+                  renderer=None):
+    update_graph(allnodes, edges, dt, is_tree, root, state)
+    if state is not None:
+        state.sync()
     auto_scale(allnodes, width, height)
-    draw_edges(screen, edges)
-    draw_nodes(allnodes, screen, 10)
+    points = screen_points(allnodes)
+    (renderer or Renderer(screen)).draw(allnodes, edges, points)
+    return SpatialGrid(points)
 
-# get the edges of a tree from its root
-def get_clicked_node(nodes, mouse_pos):
-    for node in nodes:
-        point_rect = pygame.Rect(int(node.screen_pos.x - 5), int(node.screen_pos.y - 5), 20, 20)
+# the first of the nodes whose box (the 20 pixel square reaching 5 pixels
+# up and left of its screen position) holds mouse_pos. Given a
+# SpatialGrid of the nodes' screen positions, only the nodes near the
+# mouse are tried, and the grid's positions are used
+def get_clicked_node(nodes, mouse_pos, grid=None):
+    if grid is None:
+        candidates = ((node, (node.screen_pos.x, node.screen_pos.y)) for node in nodes)
+    else:
+        x, y = mouse_pos
+        found = grid.rect(x - 16, y - 16, x + 6, y + 6)
+        candidates = zip([nodes[i] for i in found.tolist()], grid.points[found].tolist())
+    for node, (x, y) in candidates:
+        point_rect = pygame.Rect(int(x - 5), int(y - 5), 20, 20)
         if point_rect.collidepoint(mouse_pos):
             return node
 
-def run_simulation(nodes, edges, width, height, dt, is_tree=False, root=None):
+# engine is either 'python' (the Vector based functions above), 'numpy'
+# (the array engine in arrayfdl), 'parallel' (the array engine, with the
+# coulomb forces spread over a pool of processes) or 'threaded' (the array
+# engine, stepped in a simthread.SimulationThread of its own while the
+# window handles events at fps frames a second, with the coulomb forces
+# spread over a pool if processes is given; see run_threaded). nodes may
+# be a TreeView, whose nodes and edges are then simulated as a tree and
+# edges may be None
+def run_simulation(nodes, edges, width, height, dt, is_tree=False, root=None, engine='python',
+                   processes=None, fps=30):
+    if isinstance(nodes, TreeView):
+        nodes, edges, is_tree, root = nodes.nodes(), nodes.edges(), True, nodes
+    if engine == 'threaded':
+        state = arrayfdl.ArrayGraph(nodes, edges, root if is_tree else None)
+        if processes:
+            parallel.ForcePool(state, processes)
+        return run_threaded(SimulationThread(state, dt), width, height, fps)
     pygame.init()
     screen = pygame.display.set_mode((int(width * 1.4), int(height * 1.4)))
+    renderer = Renderer(screen)
     clicked_node = None
+    grid = None
+
+    if engine in ('numpy', 'parallel'):
+        state = arrayfdl.ArrayGraph(nodes, edges, root if is_tree else None)
+        if engine == 'parallel':
+            parallel.ForcePool(state, processes)
+    else:
+        state = None
 
     while True:
         mouse_pos = pygame.mouse.get_pos()
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                if state is not None and state.pool is not None:
+                    state.pool.close()
                 pygame.quit()
                 sys.exit()
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if not clicked_node:
-                    clicked_node = get_clicked_node(nodes, mouse_pos)
+                    clicked_node = get_clicked_node(nodes, mouse_pos, grid)
             elif event.type == pygame.MOUSEBUTTONUP:
                 if clicked_node:
                     clicked_node.fixed = False
+                    if state is not None:
+                        state.unpin(clicked_node)
                     clicked_node = None
 
         if clicked_node:
@@ -198,7 +297,65 @@ def run_simulation(nodes, edges, width, height, dt, is_tree=False, root=None):
             clicked_node.velocity = Vector(0, 0)
             clicked_node.force = Vector(0, 0)
             clicked_node.screen_pos = Vector(mouse_pos[0], mouse_pos[1])
+            if state is not None:
+                state.pin(clicked_node)
        
         screen.fill((0,0,0))
-        update_screen(screen, nodes, edges, width, height, dt, is_tree, root)
+        grid = update_screen(screen, nodes, edges, width, height, dt, is_tree, root, state, renderer)
         pygame.display.update()
+
+# show a simthread.SimulationThread's graph as it runs, handling events
+# fps times a second however long a step takes, so that the window stays
+# responsive while a large graph is laid out. The latest snapshot of the
+# positions is drawn whenever there is a new one (or a node is being
+# dragged), with the number of steps since the last frame in the window's
+# caption. Nodes are picked from a SpatialGrid of the points drawn, and a
+# dragged node is pinned under the mouse through the thread. The nodes
+# themselves are never written to
+def run_threaded(simulation, width, height, fps=30):
+    state = simulation.graph
+    # the thread's positions are in the order of state.nodes
+    edges = CompactGraph(state.nodes, state.src, state.dst)
+    pygame.init()
+    screen = pygame.display.set_mode((int(width * 1.4), int(height * 1.4)))
+    renderer = Renderer(screen)
+    clock = pygame.time.Clock()
+    clicked_node = None
+    grid = None
+    drawn_step = -1
+    simulation.start()
+
+    while True:
+        pos, step = simulation.snapshot()
+        points, (x_scale, y_scale, x_shift, y_shift) = scale_points(pos, width, height)
+        mouse_pos = pygame.mouse.get_pos()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                simulation.stop()
+                if state.pool is not None:
+                    state.pool.close()
+                pygame.quit()
+                sys.exit()
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                if not clicked_node and grid is not None:
+                    clicked_node = get_clicked_node(edges.nodes, mouse_pos, grid)
+            elif event.type == pygame.MOUSEBUTTONUP:
+                if clicked_node:
+                    simulation.unpin(clicked_node)
+                    clicked_node = None
+
+        if clicked_node:
+            simulation.pin(clicked_node, ((mouse_pos[0] - x_shift) / x_scale,
+                                          (mouse_pos[1] - y_shift) / y_scale))
+            points[state.index[clicked_node]] = mouse_pos
+
+        # a frame with nothing new to show is not redrawn, which leaves
+        # the time to the simulation
+        if step != drawn_step or clicked_node:
+            screen.fill((0,0,0))
+            renderer.draw(edges.nodes, edges, points)
+            grid = SpatialGrid(points)
+            pygame.display.update()
+            pygame.display.set_caption('{0} steps since the last frame'.format(step - drawn_step))
+            drawn_step = step
+        clock.tick(fps)
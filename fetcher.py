@@ -0,0 +1,251 @@
+import threading
+import Queue
+import httplib
+import socket
+import random
+import time
+import zlib
+from itertools import islice
+from urlparse import urlsplit, urljoin
+
+# whether a response says the server wants fewer requests: 429 (too many
+# requests) and 503 (unavailable) are retried after the server's
+# Retry-After, or the usual backoff if it gives none
+def rate_limited(status, body):
+    return status in (429, 503)
+
+# the body of a response, decompressed if it was gzipped
+def response_body(response):
+    body = response.read()
+    if response.getheader('content-encoding', '').lower() == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    return body
+
+
+# A pool of worker threads that download urls over kept-alive
+# connections. Each worker holds one connection per host and reuses it
+# for every request to that host, so a scrape of thousands of urls on the
+# same site opens only as many connections as there are workers. Failed
+# requests (connection errors and 5xx responses) are retried up to
+# retries times, waiting backoff * 2 ** attempt seconds (with jitter, at
+# most max_backoff) in between. When a response is rate limited, as
+# judged by throttled(status, body), every worker waits for the server's
+# Retry-After before sending another request; rate, if given, caps the
+# requests per second of the whole pool. The workers are started on first
+# use and stopped by close
+class Fetcher(object):
+    def __init__(self, concurrency=8, retries=3, backoff=.5, max_backoff=60, timeout=30,
+                 rate=None, throttled=rate_limited, headers=None, max_redirects=5):
+        self.concurrency = concurrency
+        self.retries, self.backoff, self.max_backoff = retries, backoff, max_backoff
+        self.timeout = timeout
+        self.rate = rate
+        self.throttled = throttled
+        self.headers = {'Accept-Encoding': 'gzip'}
+        self.headers.update(headers or {})
+        self.max_redirects = max_redirects
+        # the labels of the requests that failed and why, for the current
+        # (or last) call of fetch
+        self.failures = {}
+        self.tasks = Queue.Queue()
+        self.workers = []
+        # no request is sent before resume_at (while rate limited) or
+        # next_slot (to keep under rate)
+        self.lock = threading.Lock()
+        self.resume_at = self.next_slot = 0.0
+
+    def start(self):
+        while len(self.workers) < self.concurrency:
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    # stop the workers once they finish the requests already queued
+    def close(self):
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    # download an iterable of (label, url) pairs (or a dictionary of
+    # labels to urls), yielding (label, contents) pairs as the downloads
+    # finish. Only a few requests per worker are queued at a time, so the
+    # urls may come from a generator. Requests that fail for good are left
+    # out and recorded in failures. With an httpcache.ResponseCache, a
+    # response younger than max_age seconds (the cache's ttl by default) is
+    # answered from the cache, and an older one is revalidated with its
+    # ETag, so an unchanged page costs a request but not a download
+    def fetch(self, requests, cache=None, max_age=None):
+        if isinstance(requests, dict):
+            requests = requests.iteritems()
+        requests = iter(requests)
+        self.start()
+        self.failures = {}
+        # each call has its own results queue, so the results of an
+        # abandoned call cannot turn up in a later one
+        results = Queue.Queue()
+        pending = 0
+        # the cached bodies of the requests being revalidated
+        stale = {}
+        exhausted = False
+        try:
+            while True:
+                wanted = 2 * self.concurrency - pending
+                for label, url in islice(requests, wanted):
+                    wanted -= 1
+                    entry = cache.lookup(url) if cache is not None else None
+                    if entry is not None and cache.fresh(entry, max_age):
+                        yield label, entry.body
+                        continue
+                    headers = None
+                    if entry is not None and entry.etag:
+                        stale[label] = entry.body
+                        headers = {'If-None-Match': entry.etag}
+                    self.tasks.put((results, label, url, headers))
+                    pending += 1
+                exhausted = exhausted or wanted > 0
+                if not pending:
+                    if exhausted:
+                        break
+                    continue
+
+                label, url, response, error = results.get()
+                pending -= 1
+                if error is not None:
+                    stale.pop(label, None)
+                    self.failures[label] = error
+                    print "Could not open url for {0}: {1}".format(label, error)
+                    continue
+                status, headers, body = response
+                if status == 304:
+                    body = stale.pop(label)
+                    cache.revalidate(url)
+                else:
+                    stale.pop(label, None)
+                    if cache is not None:
+                        cache.store(url, body, headers.get('etag'))
+                yield label, body
+        finally:
+            if cache is not None:
+                cache.flush()
+
+    # download a dictionary of labels to urls, returning a dictionary that
+    # maps from the same labels to the contents of those urls
+    def fetch_all(self, requests, cache=None, max_age=None):
+        return dict(self.fetch(requests, cache, max_age))
+
+    # the contents of a single url, raising IOError if it cannot be had
+    def get(self, url, cache=None, max_age=None):
+        for label, contents in self.fetch([(url, url)], cache, max_age):
+            return contents
+        raise IOError(self.failures[url])
+
+    def work(self):
+        connections = {}
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    return
+                results, label, url, headers = task
+                try:
+                    results.put((label, url, self.download(connections, url, headers), None))
+                except Exception as error:
+                    results.put((label, url, None, error))
+        finally:
+            for connection in connections.itervalues():
+                connection.close()
+
+    # wait until the pool may send another request
+    def wait_turn(self):
+        with self.lock:
+            now = time.time()
+            at = max(now, self.resume_at)
+            if self.rate:
+                at = max(at, self.next_slot)
+                self.next_slot = at + 1.0 / self.rate
+        if at > now:
+            time.sleep(at - now)
+
+    # hold back every worker for delay seconds
+    def pause(self, delay):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.time() + delay)
+
+    def retry_delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * random.uniform(.5, 1)
+
+    # download one url with the worker's connections, retrying and
+    # following redirects as needed. Returns the status, headers and body
+    # of the response, which is a success or (given an If-None-Match
+    # header) a 304
+    def download(self, connections, url, request_headers=None):
+        redirects = attempt = 0
+        while True:
+            self.wait_turn()
+            try:
+                status, headers, body = self.request(connections, url, request_headers)
+            except (socket.error, httplib.HTTPException) as error:
+                status, headers, body = None, {}, str(error)
+            if status is not None and (200 <= status < 300 or status == 304):
+                return status, headers, body
+            if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                redirects += 1
+                if redirects > self.max_redirects:
+                    raise IOError('too many redirects from {0}'.format(url))
+                url = urljoin(url, headers['location'])
+                continue
+
+            error = IOError('{0} from {1}'.format(status or body, url))
+            throttled = status is not None and self.throttled(status, body)
+            if attempt >= self.retries or not (status is None or status >= 500 or throttled):
+                raise error
+            delay = self.retry_delay(attempt)
+            if throttled:
+                try:
+                    delay = max(delay, float(headers.get('retry-after', 0)))
+                except ValueError:
+                    pass
+                self.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+    # send a GET request on the worker's connection to the url's host,
+    # returning the status, headers and body of the response. A kept-alive
+    # connection that the server has since closed fails straight away, so
+    # a request on a reused connection gets a second try on a new one
+    def request(self, connections, url, headers=None):
+        parts = urlsplit(url)
+        key = parts.scheme, parts.netloc
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        for fresh in ((False, True) if key in connections else (True,)):
+            connection = connections.get(key)
+            if connection is None:
+                kind = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+                connection = connections[key] = kind(parts.netloc, timeout=self.timeout)
+            try:
+                connection.request('GET', path, headers=dict(self.headers, **(headers or {})))
+                response = connection.getresponse()
+                return response.status, dict(response.getheaders()), response_body(response)
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                del connections[key]
+                if fresh:
+                    raise
+
+
+# download a dictionary of labels to urls in max_threads threads,
+# returning a dictionary that maps from the same labels to the contents of
+# those urls. Urls that cannot be downloaded are left out
+def download_urls(url_dict, max_threads):
+    fetcher = Fetcher(max_threads)
+    try:
+        return fetcher.fetch_all(url_dict)
+    finally:
+        fetcher.close()
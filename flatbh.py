@@ -0,0 +1,411 @@
+import numpy as np
+from treeclasses import *
+import arrayfdl
+from arrayfdl import coulomb, scatter_add
+
+# treeclasses.bounding_square for an (n, 2) array of positions: the
+# centre and half-width of the smallest square containing every
+# position, never narrower than min_halfwidth
+def array_bounding_square(pos, min_halfwidth=1):
+    lo, hi = pos.min(axis=0), pos.max(axis=0)
+    mid_x, mid_y = (lo + hi) / 2.0
+    return mid_x, mid_y, max((hi - lo).max() / 2.0, min_halfwidth)
+
+# the number of levels below the root. Positions are quantized to a
+# 2**MAX_DEPTH grid along each axis, and bodies that still share a cell
+# at the deepest level are kept together in one leaf
+MAX_DEPTH = 16
+
+# spread the low 16 bits of each value out so a zero bit follows each one
+def part1by1(a):
+    a = a.astype(np.int64) & 0xffff
+    a = (a | (a << 8)) & 0x00ff00ff
+    a = (a | (a << 4)) & 0x0f0f0f0f
+    a = (a | (a << 2)) & 0x33333333
+    a = (a | (a << 1)) & 0x55555555
+    return a
+
+# interleave x and y cell coordinates into Morton (z-order) codes. The
+# two bits for each level give the quadrant, eastness + 2 * northness
+def morton_codes(ix, iy):
+    return part1by1(ix) | (part1by1(iy) << 1)
+
+
+# A Barnes-Hut quadtree stored in flat arrays instead of BHTree objects.
+# Cell i has up to four children, children[i, quadrant] (-1 where there
+# is none); a leaf holds the bodies chained from first_body[i] through
+# next_body. Each cell also has a centre of mass, total charge, body
+# count and half-width. The tree is built in bulk from a Morton sort of
+# the bodies and traversed for all bodies at once, one level at a time.
+# Unless a root square is given, it is fitted to the bodies and widened
+# by the fraction margin.
+#
+# Between simulation steps the tree can be kept with update, which only
+# relocates the bodies that left their leaf cells; a margin leaves the
+# bodies room to drift before the root square has to be refitted
+class FlatBHTree(object):
+    def __init__(self, pos, charge, mid_x=None, mid_y=None, halfwidth=None,
+                 max_depth=MAX_DEPTH, margin=0):
+        self.pos         = np.array(pos, dtype=float).reshape(-1, 2)
+        self.body_charge = np.asarray(charge, dtype=float)
+        self.fitted      = halfwidth is None
+        self.mid_x, self.mid_y = mid_x, mid_y
+        self.root_halfwidth = halfwidth
+        self.max_depth = max_depth
+        self.margin = margin
+        self.interactions = 0
+        self.build()
+
+    def __len__(self):
+        return self.ncells
+
+    # map positions to integer cell coordinates on the deepest level,
+    # clamping anything outside the root square to its border
+    def quantize(self, pos):
+        side  = 2 ** self.max_depth
+        scale = side / (2 * self.root_halfwidth)
+        ix = np.floor((pos[:, 0] - (self.mid_x - self.root_halfwidth)) * scale)
+        iy = np.floor((pos[:, 1] - (self.mid_y - self.root_halfwidth)) * scale)
+        return (np.clip(ix, 0, side - 1).astype(np.int64),
+                np.clip(iy, 0, side - 1).astype(np.int64))
+
+    # build the tree for every body at once
+    def build(self):
+        if self.fitted:
+            if len(self.pos):
+                self.mid_x, self.mid_y, self.root_halfwidth = array_bounding_square(self.pos)
+                self.root_halfwidth *= 1 + self.margin
+            else:
+                self.mid_x, self.mid_y, self.root_halfwidth = 0, 0, 1
+        self.root_halfwidth = float(self.root_halfwidth)
+        self.garbage = 0
+
+        n, depth = len(self.pos), self.max_depth
+        ix, iy = self.quantize(self.pos)
+        codes  = morton_codes(ix, iy)
+        order  = np.argsort(codes, kind='mergesort')
+        codes, ix, iy = codes[order], ix[order], iy[order]
+
+        # the deepest cell made so far for each body, in sorted order
+        cell_of = np.zeros(n, dtype=np.intp)
+        active  = np.ones(n, dtype=bool) if n > 1 else np.zeros(n, dtype=bool)
+
+        parents, levels, quadrants, xkeys, ykeys = [[-1]], [[0]], [[0]], [[0]], [[0]]
+        ncells = 1
+        for level in xrange(1, depth + 1):
+            if not active.any():
+                break
+            prefix = codes >> (2 * (depth - level))
+            same_as_prev = np.zeros(n, dtype=bool)
+            same_as_prev[1:] = active[:-1] & (prefix[1:] == prefix[:-1])
+            same_as_next = np.zeros(n, dtype=bool)
+            same_as_next[:-1] = active[1:] & (prefix[:-1] == prefix[1:])
+            starts = np.flatnonzero(active & ~same_as_prev)
+            ends   = np.flatnonzero(active & ~same_as_next)
+            counts = ends - starts + 1
+
+            new_cells = ncells + np.arange(len(starts))
+            parents.append(cell_of[starts])
+            levels.append(np.full(len(starts), level, dtype=np.intp))
+            quadrants.append(prefix[starts] & 3)
+            xkeys.append(ix[starts] >> (depth - level))
+            ykeys.append(iy[starts] >> (depth - level))
+            cell_of[active] = np.repeat(new_cells, counts)
+            ncells += len(starts)
+
+            # a cell with a single body (or on the deepest level) is a leaf
+            is_leaf = (counts == 1) | (level == depth)
+            active[active] = np.repeat(~is_leaf, counts)
+
+        self.ncells   = ncells
+        self.parent   = np.concatenate(parents).astype(np.intp)
+        self.level    = np.concatenate(levels).astype(np.intp)
+        self.xkey     = np.concatenate(xkeys).astype(np.int64)
+        self.ykey     = np.concatenate(ykeys).astype(np.int64)
+        self.children = np.full((ncells, 4), -1, dtype=np.intp)
+        self.children[self.parent[1:], np.concatenate(quadrants)[1:]] = np.arange(1, ncells)
+
+        width = 2 * self.root_halfwidth / 2.0 ** self.level
+        self.halfwidth = width / 2
+        self.center = np.empty((ncells, 2))
+        self.center[:, 0] = self.mid_x - self.root_halfwidth + (self.xkey + .5) * width
+        self.center[:, 1] = self.mid_y - self.root_halfwidth + (self.ykey + .5) * width
+
+        # chain together the bodies of each leaf, which are adjacent in
+        # sorted order
+        self.leaf_of   = np.empty(n, dtype=np.intp)
+        self.leaf_of[order] = cell_of
+        self.next_body = np.full(n, -1, dtype=np.intp)
+        self.first_body = np.full(ncells, -1, dtype=np.intp)
+        if n:
+            same_leaf = cell_of[1:] == cell_of[:-1]
+            self.next_body[order[:-1][same_leaf]] = order[1:][same_leaf]
+            firsts = np.concatenate([[0], np.flatnonzero(~same_leaf) + 1])
+            self.first_body[cell_of[firsts]] = order[firsts]
+
+        self.refresh()
+
+    # move the bodies to new positions, reusing the tree. Only the bodies
+    # that crossed out of their leaf cells are relocated, after which the
+    # aggregates are refreshed bottom-up. The tree is rebuilt from scratch
+    # instead when more than max_moved of the bodies crossed, when a body
+    # left the root square, or when the root square could be shrunk by
+    # more than half. Returns whether the tree was rebuilt
+    def update(self, pos, max_moved=.1):
+        self.pos = np.array(pos, dtype=float).reshape(-1, 2)
+        n, depth = len(self.pos), self.max_depth
+        self.relocated = 0
+        if not n:
+            self.build()
+            return True
+
+        lo, hi = self.pos.min(axis=0), self.pos.max(axis=0)
+        root_lo = np.array([self.mid_x, self.mid_y]) - self.root_halfwidth
+        root_hi = root_lo + 2 * self.root_halfwidth
+        outside = (lo < root_lo).any() or (hi >= root_hi).any()
+        shrunk  = self.fitted and (hi - lo).max() < self.root_halfwidth / 2
+
+        ix, iy = self.quantize(self.pos)
+        shift  = depth - self.level[self.leaf_of]
+        moved  = np.flatnonzero(((ix >> shift) != self.xkey[self.leaf_of]) |
+                                ((iy >> shift) != self.ykey[self.leaf_of]))
+
+        if (outside or shrunk or len(moved) > max_moved * n
+                or self.garbage > self.ncells / 2):
+            self.build()
+            return True
+
+        self.remove_bodies(moved)
+        self.insert_bodies(moved, ix, iy)
+        self.relocated = len(moved)
+        self.refresh()
+        return False
+
+    # unlink bodies from their leaves, detaching the leaves that empty
+    def remove_bodies(self, bodies):
+        leaves = self.leaf_of[bodies]
+        alone = (self.first_body[leaves] == bodies) & (self.next_body[bodies] < 0)
+        self.first_body[leaves[alone]] = -1
+        # bodies sharing a leaf on the deepest level are unlinked one by one
+        for body, leaf in zip(bodies[~alone].tolist(), leaves[~alone].tolist()):
+            if self.first_body[leaf] == body:
+                self.first_body[leaf] = self.next_body[body]
+            else:
+                prev = self.first_body[leaf]
+                while self.next_body[prev] != body:
+                    prev = self.next_body[prev]
+                self.next_body[prev] = self.next_body[body]
+        self.next_body[bodies] = -1
+        self.leaf_of[bodies] = -1
+
+        empty = np.unique(leaves)
+        empty = empty[(self.first_body[empty] < 0) & (empty != 0)]
+        self.children[self.parent[empty], self.quadrant(empty)] = -1
+        self.garbage += len(empty)
+
+    # insert bodies given their quantized positions, walking them all down
+    # from the root together. Each round, a body either moves into the
+    # child cell containing it, claims an empty quadrant as a new leaf,
+    # splits the single-body leaf it has reached, or joins a leaf on the
+    # deepest level
+    def insert_bodies(self, bodies, ix, iy):
+        depth = self.max_depth
+        cells = np.zeros(len(bodies), dtype=np.intp)
+        while len(bodies):
+            first = self.first_body[cells]
+            level = self.level[cells]
+
+            # join leaves on the deepest level, chaining each group of
+            # newcomers in front of the bodies already there
+            join = (first >= 0) & (level == depth)
+            if join.any():
+                order = np.argsort(cells[join], kind='mergesort')
+                joiners, leaves = bodies[join][order], cells[join][order]
+                same = leaves[1:] == leaves[:-1]
+                last = np.append(~same, True)
+                self.next_body[joiners[:-1][same]] = joiners[1:][same]
+                self.next_body[joiners[last]] = self.first_body[leaves[last]]
+                head = np.insert(last[:-1], 0, True)
+                self.first_body[leaves[head]] = joiners[head]
+                self.leaf_of[joiners] = leaves
+
+            # push the single body of a shallower leaf down a level; the
+            # bodies that reached it try again next round
+            retry = (first >= 0) & (level < depth)
+            split = np.unique(cells[retry])
+            if len(split):
+                others = self.first_body[split]
+                self.first_body[split] = -1
+                self.add_cells(split, others, ix[others], iy[others])
+            waiting, waiting_cells = bodies[retry], cells[retry]
+
+            descend = first < 0
+            bodies, cells = bodies[descend], cells[descend]
+            shift = depth - self.level[cells] - 1
+            quadrant = ((ix[bodies] >> shift) & 1) + 2 * ((iy[bodies] >> shift) & 1)
+            child = self.children[cells, quadrant]
+
+            # the first body to reach an empty quadrant claims it as a
+            # leaf; any others follow it in next round
+            vacant = np.flatnonzero(child < 0)
+            slots = cells[vacant] * 4 + quadrant[vacant]
+            slots, leader = np.unique(slots, return_index=True)
+            leaders = vacant[leader]
+            self.add_cells(cells[leaders], bodies[leaders], ix[bodies[leaders]], iy[bodies[leaders]])
+            child = self.children[cells, quadrant]
+
+            keep = np.ones(len(bodies), dtype=bool)
+            keep[leaders] = False
+            bodies = np.concatenate([bodies[keep], waiting])
+            cells  = np.concatenate([child[keep], waiting_cells])
+
+    # the quadrant of their parents that cells occupy
+    def quadrant(self, cells):
+        return (self.xkey[cells] & 1) + 2 * (self.ykey[cells] & 1)
+
+    # add one leaf beneath each parent, each holding a single body
+    def add_cells(self, parents, bodies, ix, iy):
+        while self.ncells + len(parents) > len(self.parent):
+            self.grow()
+        cells = self.ncells + np.arange(len(parents))
+        level = self.level[parents] + 1
+        shift = self.max_depth - level
+        self.parent[cells], self.level[cells] = parents, level
+        self.xkey[cells], self.ykey[cells] = ix >> shift, iy >> shift
+        self.children[cells] = -1
+        self.children[parents, self.quadrant(cells)] = cells
+        width = 2 * self.root_halfwidth / 2.0 ** level
+        self.halfwidth[cells] = width / 2
+        self.center[cells, 0] = self.mid_x - self.root_halfwidth + (self.xkey[cells] + .5) * width
+        self.center[cells, 1] = self.mid_y - self.root_halfwidth + (self.ykey[cells] + .5) * width
+        self.first_body[cells] = bodies
+        self.next_body[bodies] = -1
+        self.leaf_of[bodies] = cells
+        self.ncells += len(parents)
+
+    # double the capacity of the per-cell arrays
+    def grow(self):
+        for name in ('parent', 'level', 'xkey', 'ykey', 'children',
+                     'halfwidth', 'center', 'first_body'):
+            a = getattr(self, name)
+            setattr(self, name, np.concatenate([a, np.empty_like(a)]))
+
+    # recompute the charge, body count and centre of mass of every cell,
+    # from the leaves up
+    def refresh(self):
+        ncells, leaf_of, q = self.ncells, self.leaf_of, self.body_charge
+        charge = np.bincount(leaf_of, weights=q, minlength=ncells)
+        count  = np.bincount(leaf_of, minlength=ncells)
+        moment_x = np.bincount(leaf_of, weights=q * self.pos[:, 0], minlength=ncells)
+        moment_y = np.bincount(leaf_of, weights=q * self.pos[:, 1], minlength=ncells)
+
+        by_level = np.argsort(self.level[:ncells], kind='mergesort')
+        bounds = np.searchsorted(self.level[by_level], np.arange(self.level[:ncells].max() + 2))
+        for level in xrange(len(bounds) - 2, 0, -1):
+            cells = by_level[bounds[level]:bounds[level + 1]]
+            parents, inverse = np.unique(self.parent[cells], return_inverse=True)
+            for a in (charge, count, moment_x, moment_y):
+                a[parents] += np.bincount(inverse, weights=a[cells]).astype(a.dtype)
+
+        nonzero = charge != 0
+        safe = np.where(nonzero, charge, 1)
+        self.com = np.where(nonzero[:, np.newaxis],
+                            np.column_stack([moment_x / safe, moment_y / safe]),
+                            self.center[:ncells])
+        self.charge = charge
+        self.count  = count
+
+    # the Barnes-Hut approximation of the coulomb force on each of the
+    # given bodies (all of them by default). A cell whose half-width is
+    # less than theta times its distance is treated as a single charge at
+    # its centre of mass; otherwise its children are visited. Bodies are
+    # processed chunk_size at a time to bound the size of the work lists.
+    # The number of interactions evaluated is left in self.interactions
+    def forces(self, k=100, theta=.25, bodies=None, chunk_size=4096):
+        if bodies is None:
+            bodies = np.arange(len(self.pos))
+        bodies = np.asarray(bodies, dtype=np.intp)
+        out = np.zeros((len(bodies), 2))
+        self.interactions = 0
+        if not len(self.pos):
+            return out
+
+        for start in xrange(0, len(bodies), chunk_size):
+            # (row of out, cell) pairs still to be evaluated
+            rows  = np.arange(start, min(start + chunk_size, len(bodies)))
+            cells = np.zeros(len(rows), dtype=np.intp)
+            while len(rows):
+                body = bodies[rows]
+                dist_vects = self.pos[body] - self.com[cells]
+                dist = np.sqrt((dist_vects ** 2).sum(axis=1))
+                leaf = self.first_body[cells] >= 0
+                far  = ~leaf & (self.halfwidth[cells] < theta * dist)
+
+                scatter_add(out, rows[far], coulomb(dist_vects[far], k,
+                            self.body_charge[body[far]] * self.charge[cells[far]]))
+                self.interactions += np.count_nonzero(far)
+                self.leaf_forces(out, bodies, rows[leaf], cells[leaf], k)
+
+                opened = ~leaf & ~far
+                children = self.children[cells[opened]].ravel()
+                rows = np.repeat(rows[opened], 4)
+                keep = children >= 0
+                rows, cells = rows[keep], children[keep]
+                keep = self.count[cells] > 0
+                rows, cells = rows[keep], cells[keep]
+        return out
+
+    # the exact forces on bodies[rows] from the bodies in the given leaves
+    def leaf_forces(self, out, bodies, rows, leaves, k):
+        others = self.first_body[leaves]
+        while len(rows):
+            body = bodies[rows]
+            dist_vects = self.pos[body] - self.pos[others]
+            apart = (others != body) & (dist_vects != 0).any(axis=1)
+            scatter_add(out, rows[apart], coulomb(dist_vects[apart], k,
+                        self.body_charge[body[apart]] * self.body_charge[others[apart]]))
+            self.interactions += np.count_nonzero(apart)
+            others = self.next_body[others]
+            keep = others >= 0
+            rows, others = rows[keep], others[keep]
+
+
+# build a FlatBHTree over a list of nodes; a drop in for nodes_to_bh_tree
+def nodes_to_flat_bh_tree(nodes, margin=0):
+    nodes = list(nodes)
+    tree = FlatBHTree([tuple(node.pos) for node in nodes],
+                      [node.charge for node in nodes], margin=margin)
+    tree.nodes = nodes
+    return tree
+
+# move a tree from nodes_to_flat_bh_tree to the current positions of its
+# nodes, reusing as much of it as possible
+def update_flat_bh_tree(tree, max_moved=.1):
+    return tree.update([tuple(node.pos) for node in tree.nodes], max_moved)
+
+# update the forces of an ArrayGraph using a Barnes-Hut tree over its
+# current positions, returning the number of interactions evaluated. As
+# with arrayfdl.update_coulomb_forces, only the free nodes are pushed. If
+# a tree from a previous step is given it is updated rather than rebuilt.
+# Graphs with a worker pool evaluate the tree there instead
+def update_forces_bh(graph, theta=.25, k=100, tree=None):
+    if graph.pool is not None:
+        interactions = graph.pool.update_forces_bh(theta, k)
+    else:
+        if tree is None:
+            tree = FlatBHTree(graph.pos, graph.charge)
+        else:
+            tree.update(graph.pos)
+        free = np.flatnonzero(~graph.fixed)
+        graph.force[free] += tree.forces(k, theta, free)
+        interactions = tree.interactions
+    arrayfdl.update_hooke_forces(graph)
+    return interactions
+
+# evolve the state of an ArrayGraph with time-step dt, approximating
+# the coulomb forces with a Barnes-Hut tree
+def update_graph_bh(graph, dt, theta=.25, k=100, tree=None):
+    interactions = update_forces_bh(graph, theta, k, tree)
+    arrayfdl.update_velocs(graph, dt)
+    arrayfdl.update_posns(graph, dt)
+    return interactions
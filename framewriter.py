@@ -0,0 +1,128 @@
+import os, json, mmap, struct, zlib, threading, Queue
+import pygame
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# the bytes of a PNG chunk
+def png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+# encode rows of 8-bit RGB pixels (as from pygame.image.tostring) as a
+# PNG. zlib lets go of the interpreter lock while it compresses, so
+# encoders in several threads run alongside the simulation
+def encode_png(pixels, width, height, level=6):
+    stride = 3 * width
+    # each row starts with its filter type, 0 for none
+    rows = ''.join('\0' + pixels[start:start + stride]
+                   for start in xrange(0, stride * height, stride))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (PNG_SIGNATURE + png_chunk('IHDR', header) +
+            png_chunk('IDAT', zlib.compress(rows, level)) + png_chunk('IEND', ''))
+
+
+# Saves frames of an animation (such as a layout converging) without
+# holding up whatever draws them. add copies a surface's pixels, which is
+# quick, and hands them to a pool of encoder threads that compress them to
+# directory/pattern.format(frame) as PNGs. The queue between them holds at
+# most queue_size frames, so if the encoders fall behind add waits instead
+# of memory filling up. Only every stride-th frame is kept, and once
+# max_frames have been kept add refuses the rest (see done). With
+# raw_path, each kept frame's RGB pixels are also copied into one
+# memory-mapped file, frame after frame, for encoding into a video later
+# (e.g. with ffmpeg -f rawvideo -pix_fmt rgb24); its size and frame count
+# are written to raw_path + '.json' by close. directory may be None to
+# write only the raw file. An encoder that fails stops the writer, and
+# the error is raised from the next add or close
+class FrameWriter(object):
+    def __init__(self, directory, pattern='pic{0}.png', workers=2, queue_size=8, stride=1,
+                 max_frames=None, raw_path=None, level=6):
+        self.directory, self.pattern = directory, pattern
+        self.stride, self.max_frames = stride, max_frames
+        self.level = level
+        # how many frames have been offered and how many kept
+        self.offered = self.frames = 0
+        self.size = None
+        self.error = None
+        self.raw_path, self.raw_file, self.raw = raw_path, None, None
+        self.tasks = Queue.Queue(queue_size)
+        self.workers = []
+        if directory is not None:
+            for i in xrange(workers):
+                worker = threading.Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    # whether max_frames have been kept
+    def done(self):
+        return self.max_frames is not None and self.frames >= self.max_frames
+
+    # offer the current contents of a surface as the next frame. Returns
+    # whether it was kept
+    def add(self, surface):
+        if self.error is not None:
+            raise self.error
+        offered, self.offered = self.offered, self.offered + 1
+        if offered % self.stride or self.done():
+            return False
+        size = surface.get_size()
+        if self.size is None:
+            self.size = size
+        elif size != self.size:
+            raise ValueError('frame is {0[0]}x{0[1]}, not {1[0]}x{1[1]}'.format(size, self.size))
+        pixels = pygame.image.tostring(surface, 'RGB')
+        if self.raw_path is not None:
+            self.write_raw(pixels)
+        if self.workers:
+            self.tasks.put((self.frames, pixels))
+        self.frames += 1
+        return True
+
+    # copy a frame's pixels into the raw file, which is grown by doubling
+    # (or made max_frames long to begin with)
+    def write_raw(self, pixels):
+        start = self.frames * len(pixels)
+        if self.raw is None or start + len(pixels) > len(self.raw):
+            capacity = max(self.max_frames or 0, 2 * self.frames, 1) * len(pixels)
+            if self.raw is None:
+                self.raw_file = open(self.raw_path, 'w+b')
+            else:
+                self.raw.close()
+            self.raw_file.truncate(capacity)
+            self.raw = mmap.mmap(self.raw_file.fileno(), capacity)
+        self.raw[start:start + len(pixels)] = pixels
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.error is not None:
+                continue
+            frame, pixels = task
+            try:
+                path = os.path.join(self.directory, self.pattern.format(frame))
+                with open(path, 'wb') as out_file:
+                    out_file.write(encode_png(pixels, self.size[0], self.size[1], self.level))
+            except Exception as error:
+                self.error = error
+
+    # wait for the frames already added to be written, and finish the raw
+    # file
+    def close(self):
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.raw is not None:
+            self.raw.close()
+            self.raw_file.truncate(self.frames * self.size[0] * self.size[1] * 3)
+            self.raw_file.close()
+            self.raw = None
+            with open(self.raw_path + '.json', 'w') as out_file:
+                json.dump({'width': self.size[0], 'height': self.size[1], 'frames': self.frames,
+                           'pix_fmt': 'rgb24'}, out_file)
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,275 @@
+import os, sys, mmap, json, struct, argparse, cPickle
+from itertools import islice
+import numpy as np
+from treeclasses import *
+from graphstore import CompactGraph
+import arrayfdl
+
+GRAPH_VERSION = 1
+GRAPH_MAGIC = 'FDLGRAPH'
+# the magic, the version, a reserved word and the offset of the table of
+# contents, which is only filled in once the file is complete
+HEADER = struct.Struct('<IIQ')
+HEADER_SIZE = len(GRAPH_MAGIC) + HEADER.size
+
+# the columns a graph file may hold and their types. id, name_length and
+# pos have a row per node, with the nodes' names concatenated in names;
+# src and dst have a row per edge. pos, a stored layout, is optional
+COLUMNS = {'id': '<i8', 'name_length': '<i4', 'names': '|u1', 'pos': '<f8',
+           'src': '<u4', 'dst': '<u4'}
+# the number of values in a row of each column that has more than one
+ROW_WIDTH = {'pos': 2}
+NODE_COLUMNS = ('id', 'name_length')
+EDGE_COLUMNS = ('src', 'dst')
+
+# pending rows of a column are written out once they reach this size
+CHUNK_SIZE = 1 << 22
+
+# the id of a node to store: its id attribute (such as a Facebook id) if
+# it has an integer one, else -1
+def node_id(node):
+    try:
+        return int(node.id)
+    except (AttributeError, TypeError, ValueError):
+        return -1
+
+def encode_name(name):
+    return name.encode('utf-8') if isinstance(name, unicode) else str(name)
+
+
+# Writes a graph file a batch of nodes or edges at a time, so that a graph
+# never has to be held in memory whole. Each column's rows are gathered
+# until there are chunk_size bytes of them and then written as one chunk
+# aligned to 8 bytes; a table of contents at the end of the file records
+# where each column's chunks lie. The file is written under a temporary
+# name and moved into place by close
+class GraphWriter(object):
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path, self.chunk_size = path, chunk_size
+        self.out_file = open(path + '.tmp', 'wb')
+        self.out_file.write(GRAPH_MAGIC + HEADER.pack(GRAPH_VERSION, 0, 0))
+        # the rows of each column waiting to be written, their size, and
+        # the (offset, count) of each chunk already written
+        self.pending, self.pending_size = {}, {}
+        self.chunks = {}
+        self.nodes = self.edges = 0
+
+    def append(self, column, rows):
+        rows = np.ascontiguousarray(rows, dtype=COLUMNS[column])
+        self.pending.setdefault(column, []).append(rows)
+        self.pending_size[column] = self.pending_size.get(column, 0) + rows.nbytes
+        if self.pending_size[column] >= self.chunk_size:
+            self.flush(column)
+
+    def flush(self, column):
+        rows = self.pending.pop(column, [])
+        self.pending_size.pop(column, None)
+        if not rows:
+            return
+        rows = np.concatenate(rows)
+        self.out_file.write('\0' * (-self.out_file.tell() % 8))
+        self.chunks.setdefault(column, []).append((self.out_file.tell(), len(rows)))
+        self.out_file.write(rows.tostring())
+
+    # add nodes with the given names, and optionally their ids and (x, y)
+    # positions. Either every batch of nodes has positions or none does
+    def add_nodes(self, names, ids=None, pos=None):
+        names = [encode_name(name) for name in names]
+        if ids is None:
+            ids = np.full(len(names), -1)
+        self.append('id', ids)
+        self.append('name_length', [len(name) for name in names])
+        self.append('names', np.frombuffer(''.join(names), np.uint8))
+        if pos is not None:
+            self.append('pos', np.reshape(pos, (len(names), 2)))
+        self.nodes += len(names)
+
+    # add edges between the nodes at the given indices
+    def add_edges(self, src, dst):
+        if len(src) != len(dst):
+            raise ValueError('src and dst differ in length')
+        self.append('src', src)
+        self.append('dst', dst)
+        self.edges += len(src)
+
+    # write the remaining rows and the table of contents, with meta (a
+    # dictionary that can be saved as JSON) stored alongside
+    def close(self, meta=None):
+        for column in self.pending.keys():
+            self.flush(column)
+        counts = dict((column, sum(count for offset, count in chunks))
+                      for column, chunks in self.chunks.iteritems())
+        for column in NODE_COLUMNS + ('pos',) * ('pos' in counts):
+            if counts.get(column, 0) != self.nodes:
+                raise ValueError('{0} has {1} rows for {2} nodes'
+                                 .format(column, counts.get(column, 0), self.nodes))
+
+        toc = json.dumps({'nodes': self.nodes, 'edges': self.edges, 'meta': meta or {},
+                          'columns': dict((column, [COLUMNS[column], chunks])
+                                          for column, chunks in self.chunks.iteritems())})
+        self.out_file.write('\0' * (-self.out_file.tell() % 8))
+        toc_offset = self.out_file.tell()
+        self.out_file.write(toc)
+        self.out_file.seek(len(GRAPH_MAGIC))
+        self.out_file.write(HEADER.pack(GRAPH_VERSION, 0, toc_offset))
+        self.out_file.close()
+        os.rename(self.path + '.tmp', self.path)
+
+
+# A graph file opened for reading. The file is memory-mapped and each
+# column is read only when it is asked for: a column written as one chunk
+# is a read-only view of the file, and one written in several chunks is
+# copied together. Raises IOError for files that are not graph files, are
+# of another version or were never finished
+class GraphFile(object):
+    def __init__(self, path):
+        with open(path, 'rb') as in_file:
+            start = in_file.read(HEADER_SIZE)
+            if len(start) < HEADER_SIZE or not start.startswith(GRAPH_MAGIC):
+                raise IOError('{0} is not a graph file'.format(path))
+            version, reserved, toc_offset = HEADER.unpack(start[len(GRAPH_MAGIC):])
+            if version != GRAPH_VERSION:
+                raise IOError('{0} is a version {1} graph file'.format(path, version))
+            if not toc_offset:
+                raise IOError('{0} is incomplete'.format(path))
+            in_file.seek(toc_offset)
+            toc = json.loads(in_file.read())
+            self.buf = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.nodes, self.edges = toc['nodes'], toc['edges']
+        self.meta = toc['meta']
+        self.layout = toc['columns']
+        self.columns = {}
+        self.name_start = None
+
+    def __len__(self):
+        return self.nodes
+
+    def __contains__(self, column):
+        return column in self.layout
+
+    def column(self, column):
+        if column not in self.columns:
+            # a column with no rows has no chunks either
+            dtype, chunks = self.layout.get(column, (COLUMNS[column], []))
+            width = ROW_WIDTH.get(column, 1)
+            parts = [np.frombuffer(self.buf, np.dtype(dtype), count * width, offset)
+                     for offset, count in chunks]
+            if len(parts) == 1:
+                array = parts[0]
+            else:
+                array = np.concatenate(parts or [np.empty(0, dtype)])
+            if width > 1:
+                array = array.reshape(-1, width)
+            self.columns[column] = array
+        return self.columns[column]
+
+    # the name of the node at row i
+    def name(self, i):
+        if self.name_start is None:
+            self.name_start = np.concatenate([[0], np.cumsum(self.column('name_length'))])
+        start, stop = self.name_start[i], self.name_start[i + 1]
+        return self.column('names')[start:stop].tostring().decode('utf-8')
+
+    def names(self):
+        blob = self.column('names').tostring()
+        names, start = [], 0
+        for length in self.column('name_length').tolist():
+            names.append(blob[start:start + length].decode('utf-8'))
+            start += length
+        return names
+
+    # a Node for every row, with its name, its id if it has one, and its
+    # stored position if there is a layout
+    def make_nodes(self):
+        nodes = [Node(name) for name in self.names()]
+        for node, id_num in zip(nodes, self.column('id').tolist()):
+            if id_num >= 0:
+                node.id = str(id_num)
+        if 'pos' in self:
+            for node, (x, y) in zip(nodes, self.column('pos').tolist()):
+                node.pos = Vector(x, y)
+        return nodes
+
+    # a CompactGraph of the file's edges on the given nodes (by default,
+    # new ones from make_nodes)
+    def compact_graph(self, nodes=None):
+        if nodes is None:
+            nodes = self.make_nodes()
+        return CompactGraph(nodes, self.column('src'), self.column('dst'))
+
+    # an arrayfdl.ArrayGraph of the file straight from its columns, with no
+    # Node objects, starting from the stored layout if there is one and
+    # from random positions within width otherwise
+    def array_graph(self, charge=100, width=500, seed=None):
+        if 'pos' in self:
+            pos = self.column('pos')
+        else:
+            pos = np.random.RandomState(seed).randint(0, width + 1, size=(self.nodes, 2))
+        return arrayfdl.ArrayGraph.from_arrays(pos, np.full(self.nodes, float(charge)),
+                                               self.column('src'), self.column('dst'))
+
+
+# write a graph of nodes and edges (node tuples or a CompactGraph) to a
+# graph file, with the nodes' positions if layout is set
+def save_graph(path, nodes, edges, layout=False, meta=None, batch_size=1 << 16):
+    nodes = list(nodes)
+    if isinstance(edges, CompactGraph) and edges.nodes != nodes:
+        edges = list(edges)
+    writer = GraphWriter(path)
+    for start in xrange(0, len(nodes), batch_size):
+        batch = nodes[start:start + batch_size]
+        pos = [tuple(node.pos) for node in batch] if layout else None
+        writer.add_nodes([getattr(node, 'name', '') for node in batch],
+                         [node_id(node) for node in batch], pos)
+    if isinstance(edges, CompactGraph):
+        writer.add_edges(edges.src, edges.dst)
+    else:
+        index = dict((node, i) for i, node in enumerate(nodes))
+        edges = iter(edges)
+        while True:
+            batch = [(index[a], index[b]) for a, b in islice(edges, batch_size)]
+            if not batch:
+                break
+            src, dst = zip(*batch)
+            writer.add_edges(src, dst)
+    writer.close(meta)
+
+# nodes, edges (as a CompactGraph) and the open GraphFile of a graph file
+def load_graph(path):
+    graph_file = GraphFile(path)
+    edges = graph_file.compact_graph()
+    return edges.nodes, edges, graph_file
+
+# whether a file is a graph file rather than, say, an old pickle
+def is_graph_file(path):
+    with open(path, 'rb') as in_file:
+        return in_file.read(len(GRAPH_MAGIC)) == GRAPH_MAGIC
+
+# convert a graph pickled by Facebook.pickle_friend_graph before it wrote
+# graph files (a dictionary or list of nodes and a collection of node
+# tuples) to a graph file, keeping the nodes' positions if they have them
+def import_pickle(pickle_path, path):
+    with open(pickle_path, 'rb') as in_file:
+        nodes, edges = cPickle.load(in_file)
+    if isinstance(nodes, dict):
+        nodes = nodes.values()
+    nodes = list(nodes)
+    layout = bool(nodes) and all(hasattr(node, 'pos') for node in nodes)
+    save_graph(path, nodes, edges, layout, {'imported_from': os.path.basename(pickle_path)})
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Convert pickled friend graphs to graph files.')
+    parser.add_argument('pickles', nargs='+')
+    parser.add_argument('--out-dir', default=None,
+                        help='write each graph to OUT_DIR/<pickle>.fdg instead of beside it')
+    args = parser.parse_args(argv)
+    for pickle_path in args.pickles:
+        name = os.path.splitext(os.path.basename(pickle_path))[0] + '.fdg'
+        path = os.path.join(args.out_dir or os.path.dirname(pickle_path), name)
+        import_pickle(pickle_path, path)
+        graph_file = GraphFile(path)
+        sys.stderr.write('{0} -> {1}: {2} nodes, {3} edges\n'
+                         .format(pickle_path, path, graph_file.nodes, graph_file.edges))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
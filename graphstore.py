@@ -0,0 +1,180 @@
+import threading
+import numpy as np
+from treeclasses import *
+
+# the smallest unsigned integer type that can index n nodes
+def index_dtype(n):
+    for dtype in (np.uint16, np.uint32):
+        if n <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int64
+
+# the neighbours of every node of an undirected graph in compressed
+# sparse row form: the neighbours of node i are
+# neighbours[indptr[i]:indptr[i + 1]]
+def csr_adjacency(n, src, dst):
+    ends   = np.concatenate([src, dst])
+    others = np.concatenate([dst, src])
+    order  = np.argsort(ends, kind='mergesort')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(ends, minlength=n))])
+    return indptr, others[order]
+
+
+# A graph whose edges are held as two arrays of node indices rather than
+# a list of (Node, Node) tuples. Iterating over it still yields node
+# tuples, so it can be passed anywhere an edge list is expected, while
+# the array engine, drawing and saving use the index arrays directly
+class CompactGraph(object):
+    def __init__(self, nodes, src, dst):
+        self.nodes = list(nodes)
+        dtype = index_dtype(len(self.nodes))
+        self.src = np.asarray(src).astype(dtype, copy=False)
+        self.dst = np.asarray(dst).astype(dtype, copy=False)
+        self.adjacency = None
+
+    def __len__(self):
+        return len(self.src)
+
+    def __iter__(self):
+        nodes = self.nodes
+        for a, b in zip(self.src.tolist(), self.dst.tolist()):
+            yield nodes[a], nodes[b]
+
+    # the (indptr, neighbours) CSR view of the graph, built on first use
+    def csr(self):
+        if self.adjacency is None:
+            self.adjacency = csr_adjacency(len(self.nodes), self.src, self.dst)
+        return self.adjacency
+
+    def neighbours(self, i):
+        indptr, neighbours = self.csr()
+        return neighbours[indptr[i]:indptr[i + 1]]
+
+    def degrees(self):
+        return np.diff(self.csr()[0])
+
+    # save the graph's edges and node names to a .npz file
+    def save(self, path):
+        names = [to_ascii(getattr(node, 'name', '')) for node in self.nodes]
+        np.savez(path, src=self.src, dst=self.dst, names=np.array(names, dtype=str))
+
+    # load a graph saved with save, making a Node for each name unless the
+    # nodes are given
+    @classmethod
+    def load(cls, path, nodes=None):
+        data = np.load(path)
+        if nodes is None:
+            nodes = [Node(name) for name in data['names'].tolist()]
+        return cls(nodes, data['src'], data['dst'])
+
+
+# A CompactGraph built up as its edges turn up, e.g. from the mutual
+# friend lists of a scrape as they download. Each undirected edge is kept
+# once, as (smaller index, larger index), however often it is added, in
+# arrays that double in size as they fill. One thread may add edges while
+# another reads the ones added so far; finished is set by finish once
+# there are no more to come
+class GraphBuilder(object):
+    def __init__(self, nodes, capacity=1024):
+        self.nodes = list(nodes)
+        dtype = index_dtype(len(self.nodes))
+        self.src = np.empty(capacity, dtype)
+        self.dst = np.empty(capacity, dtype)
+        self.count = 0
+        # lo * n + hi for every edge (lo, hi) added so far
+        self.keys = set()
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def __len__(self):
+        return self.count
+
+    # add an edge from node i to each of the nodes others, returning the
+    # number of edges that were new
+    def add_edges(self, i, others):
+        n = len(self.nodes)
+        keys = self.keys
+        new = []
+        for j in others:
+            key = i * n + j if i < j else j * n + i
+            if i != j and key not in keys:
+                keys.add(key)
+                new.append(key)
+        if new:
+            new = np.array(new, dtype=np.int64)
+            with self.lock:
+                count = self.count
+                if count + len(new) > len(self.src):
+                    size = max(2 * len(self.src), count + len(new))
+                    self.src = np.resize(self.src, size)
+                    self.dst = np.resize(self.dst, size)
+                self.src[count:count + len(new)] = new // n
+                self.dst[count:count + len(new)] = new % n
+                self.count = count + len(new)
+        return len(new)
+
+    def finish(self):
+        self.finished.set()
+
+    # copies of the index arrays of the edges from the start-th on
+    def edges(self, start=0):
+        with self.lock:
+            return self.src[start:self.count].copy(), self.dst[start:self.count].copy()
+
+    # the edges from the start-th on as node tuples
+    def edge_tuples(self, start=0):
+        src, dst = self.edges(start)
+        nodes = self.nodes
+        return [(nodes[a], nodes[b]) for a, b in zip(src.tolist(), dst.tolist())]
+
+    # a CompactGraph of the edges added so far
+    def graph(self):
+        src, dst = self.edges()
+        return CompactGraph(self.nodes, src, dst)
+
+
+# a CompactGraph from a list of nodes and a list (or set) of node tuples,
+# such as the output of get_edges or complete_graph
+def from_edges(nodes, edges):
+    nodes = list(nodes)
+    index = dict((node, i) for i, node in enumerate(nodes))
+    dtype = index_dtype(len(nodes))
+    edges = list(edges)
+    src = np.fromiter((index[e[0]] for e in edges), dtype, len(edges))
+    dst = np.fromiter((index[e[1]] for e in edges), dtype, len(edges))
+    return CompactGraph(nodes, src, dst)
+
+# a CompactGraph of a tree, with the nodes in the order of all_nodes and
+# the edges in the order of get_edges
+def from_tree(root):
+    nodes, src = [], []
+    stack = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        if parent >= 0:
+            src.append(parent)
+        i = len(nodes)
+        nodes.append(node)
+        stack.extend((child, i) for child in reversed(node.children))
+    dst = np.arange(1, len(nodes))
+    return CompactGraph(nodes, src, dst)
+
+# a CompactGraph from the (node dict, edge set) pair that
+# Facebook.friends_graph returns
+def from_friends_graph(graph):
+    friend_nodes, edges = graph
+    if isinstance(edges, CompactGraph):
+        return edges
+    return from_edges(friend_nodes.values(), edges)
+
+# a complete graph on n new nodes, built without any edge tuples
+def complete_graph(n):
+    dtype = index_dtype(n)
+    counts = np.arange(n - 1, -1, -1)
+    src = np.repeat(np.arange(n, dtype=dtype), counts)
+    dst = np.empty(len(src), dtype=dtype)
+    start = 0
+    for i in xrange(n - 1):
+        dst[start:start + counts[i]] = np.arange(i + 1, n, dtype=dtype)
+        start += counts[i]
+    return CompactGraph([Node() for x in xrange(n)], src, dst)
@@ -0,0 +1,113 @@
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from urllib import urlencode
+from urlparse import urlsplit, parse_qsl
+
+# the layout of the cache database; a database of another version is
+# emptied when it is opened
+CACHE_VERSION = 1
+
+# a cached response: its body, its ETag (or None) and when it was last
+# downloaded or revalidated, in seconds since the epoch
+Entry = namedtuple('Entry', 'body etag fetched')
+
+# A disk-backed cache of http responses, kept in an sqlite database at
+# path. Responses are keyed by the path and query of their url, less the
+# query parameters in ignore_params (such as an access token that changes
+# between sessions), so a Graph API response is keyed by its endpoint and
+# id. Bodies are stored compressed. A response is fresh for ttl seconds
+# after it was downloaded; a stale response is kept so that it can be
+# revalidated with its ETag, and used outright by an incremental refresh.
+# Once the stored bodies pass max_bytes, the least recently used
+# responses are evicted
+class ResponseCache(object):
+    def __init__(self, path, ttl=24 * 60 * 60, max_bytes=1 << 28,
+                 ignore_params=('access_token',)):
+        self.ttl, self.max_bytes = ttl, max_bytes
+        self.ignore_params = set(ignore_params)
+        # the fetch results are handed to the cache from whichever thread
+        # is reading them
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS responses')
+            self.db.execute('PRAGMA user_version={0}'.format(CACHE_VERSION))
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, '
+                        'body BLOB, etag TEXT, fetched REAL, used REAL, size INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def key(self, url):
+        parts = urlsplit(url)
+        params = sorted((name, value) for name, value in parse_qsl(parts.query, True)
+                        if name not in self.ignore_params)
+        return parts.netloc + parts.path + ('?' + urlencode(params) if params else '')
+
+    # the cached response to a url as an Entry, or None. Looking a
+    # response up counts as using it
+    def lookup(self, url):
+        key = self.key(url)
+        with self.lock:
+            row = self.db.execute('SELECT body, etag, fetched FROM responses WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+        body, etag, fetched = row
+        return Entry(zlib.decompress(body), etag, fetched)
+
+    # whether an entry is younger than max_age seconds (the cache's ttl by
+    # default)
+    def fresh(self, entry, max_age=None):
+        return time.time() - entry.fetched < (self.ttl if max_age is None else max_age)
+
+    def store(self, url, body, etag=None):
+        key = self.key(url)
+        blob = sqlite3.Binary(zlib.compress(body))
+        now = time.time()
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, blob, etag, now, now, len(blob)))
+            self.size += len(blob) - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    # mark the cached response to a url as just downloaded, when the
+    # server says it has not changed
+    def revalidate(self, url):
+        with self.lock:
+            now = time.time()
+            self.db.execute('UPDATE responses SET fetched = ?, used = ? WHERE key = ?',
+                            (now, now, self.key(url)))
+
+    # drop the least recently used responses until the cache is back
+    # under max_bytes. Called with the lock held
+    def evict(self):
+        rows = self.db.execute('SELECT key, size FROM responses ORDER BY used')
+        dropped = []
+        for key, size in rows:
+            if self.size <= self.max_bytes:
+                break
+            dropped.append((key,))
+            self.size -= size
+        self.db.executemany('DELETE FROM responses WHERE key = ?', dropped)
+
+    # write the changes so far to disk
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
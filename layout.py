@@ -0,0 +1,254 @@
+import sys, os.path, argparse, cPickle
+import numpy as np
+from fdl import *
+import arrayfdl, flatbh, parallel, graphfile
+from treelayout import seed_tree
+
+# the total kinetic energy of a graph, taking every node to have unit mass
+def kinetic_energy(velocities):
+    return .5 * (np.asarray(velocities) ** 2).sum()
+
+# the largest distance any node moved between two sets of positions
+def max_displacement(old_pos, new_pos):
+    return np.sqrt(((np.asarray(new_pos) - np.asarray(old_pos)) ** 2).sum(axis=1)).max()
+
+# the residual force jitters as nodes snap to whole pixels, so it must
+# stay below force_tol this many steps for a layout to count as settled
+SETTLED_STEPS = 10
+
+# the mean length of the net force on the free nodes: how far a layout
+# is from balance, whatever schedule produced it
+def residual_force(force, fixed=None):
+    force = np.asarray(force, dtype=float).reshape(-1, 2)
+    if fixed is not None:
+        force = force[~np.asarray(fixed)]
+    return np.sqrt((force ** 2).sum(axis=1)).mean() if len(force) else 0.0
+
+# the residual_force of an ArrayGraph at its current positions, leaving
+# its forces as they were
+def graph_residual(state, bh=False, theta=.25):
+    saved = state.force.copy()
+    state.force[:] = 0
+    if bh:
+        flatbh.update_forces_bh(state, theta)
+    else:
+        arrayfdl.update_forces(state)
+    residual = residual_force(state.force, state.fixed)
+    state.force[:] = saved
+    return residual
+
+# step an ArrayGraph until it settles: until the total kinetic energy
+# drops below energy_tol, no node moves more than disp_tol in a step, the
+# residual_force at the start of SETTLED_STEPS steps in a row is below
+# force_tol, or max_steps have been taken. Positions are whole pixels, so a settled layout still
+# has nodes jittering by a pixel; the default disp_tol allows for that.
+# How far a node moves in a step depends on the schedule as well as on
+# the layout, so force_tol (with disp_tol None) is the test to use when
+# comparing schedules. bh approximates the coulomb forces with a
+# Barnes-Hut tree, and adaptive steps with an arrayfdl.AdaptiveStepper
+# starting from dt instead of the fixed schedule. Returns the number of
+# steps taken
+def settle(state, dt, bh=False, max_steps=5000, energy_tol=None, disp_tol=1.5, theta=.25,
+           adaptive=False, force_tol=None):
+    update_forces = (lambda graph: flatbh.update_forces_bh(graph, theta)) if bh else arrayfdl.update_forces
+    # how many steps in a row have begun below force_tol
+    balanced = [0]
+    # the forces of a step, noting how far from balance they leave the
+    # graph before it moves
+    def forces(graph):
+        update_forces(graph)
+        if force_tol is not None:
+            below = residual_force(graph.force, graph.fixed) < force_tol
+            balanced[0] = balanced[0] + 1 if below else 0
+    if adaptive:
+        step = arrayfdl.AdaptiveStepper(state, dt, update_forces=forces).step
+    else:
+        def step():
+            forces(state)
+            arrayfdl.update_velocs(state, dt)
+            arrayfdl.update_posns(state, dt)
+
+    old_pos = state.pos.copy()
+    steps = 0
+    while steps < max_steps:
+        step()
+        steps += 1
+        if energy_tol is not None and kinetic_energy(state.velocity) < energy_tol:
+            break
+        if disp_tol is not None and max_displacement(old_pos, state.pos) < disp_tol:
+            break
+        if balanced[0] >= SETTLED_STEPS:
+            break
+        old_pos[:] = state.pos
+    return steps
+
+# step a graph without opening a window until it settles, as in settle.
+# engine is 'numpy' (the array engine, optionally with a
+# parallel.ForcePool over processes) or 'python'; adaptive steps are only
+# available with the array engine. The final positions are written back
+# to the nodes and returned as a list of (x, y) tuples in the order of
+# nodes, along with the number of steps taken
+def run_headless(nodes, edges, dt, is_tree=False, root=None, engine='numpy', bh=False,
+                 max_steps=5000, energy_tol=None, disp_tol=1.5, processes=None, theta=.25,
+                 adaptive=False, force_tol=None):
+    nodes = list(nodes)
+    if adaptive and engine != 'numpy':
+        raise ValueError('adaptive steps need the numpy engine')
+    if engine == 'numpy':
+        state = arrayfdl.ArrayGraph(nodes, edges, root if is_tree else None)
+        if processes:
+            parallel.ForcePool(state, processes)
+        try:
+            steps = settle(state, dt, bh, max_steps, energy_tol, disp_tol, theta, adaptive,
+                           force_tol)
+        finally:
+            if state.pool is not None:
+                state.pool.close()
+            state.sync(velocities=True)
+        return [tuple(node.pos) for node in nodes], steps
+
+    old_pos = pos = [tuple(node.pos) for node in nodes]
+    steps = balanced = 0
+    while steps < max_steps:
+        if bh:
+            update_forces_bh(flatbh.nodes_to_flat_bh_tree(nodes), nodes, edges, theta)
+        else:
+            update_forces(nodes, edges, is_tree, root)
+        if force_tol is not None:
+            below = residual_force([tuple(node.force) for node in nodes],
+                                   [node.fixed for node in nodes]) < force_tol
+            balanced = balanced + 1 if below else 0
+        update_velocs(nodes, dt)
+        update_posns(nodes, dt)
+        steps += 1
+        pos = [tuple(node.pos) for node in nodes]
+        if energy_tol is not None and kinetic_energy([tuple(node.velocity) for node in nodes]) < energy_tol:
+            break
+        if disp_tol is not None and max_displacement(old_pos, pos) < disp_tol:
+            break
+        if balanced >= SETTLED_STEPS:
+            break
+        old_pos = pos
+    return pos, steps
+
+
+# build the graph named by a command line argument: "bin:LEVELS" for a
+# binary tree, "com:N" for a complete graph, or the path of a graph file
+# saved by Facebook.save_friend_graph (or of an old pickled friend graph).
+# Returns nodes, edges and the root of a tree (None for other graphs)
+def load_graph(spec):
+    kind, _, arg = spec.partition(':')
+    if kind == 'bin' and arg:
+        root = binary_tree(int(arg))
+        return all_nodes(root), get_edges(root), root
+    elif kind == 'com' and arg:
+        nodes, edges = complete_graph(int(arg))
+        return nodes, edges, None
+    elif graphfile.is_graph_file(spec):
+        nodes, edges, graph_file = graphfile.load_graph(spec)
+        return nodes, edges, None
+    else:
+        with open(spec, 'rb') as in_file:
+            nodes, edges = cPickle.load(in_file)
+        if isinstance(nodes, dict):
+            nodes = nodes.values()
+        return list(nodes), list(edges), None
+
+# lay out a graph from the same starting positions with the fixed and the
+# adaptive schedules, returning the number of steps each took, the
+# residual_force each left the layout with, and the adaptive layout
+# (which is left on the nodes). Both runs stop at the same quality: once
+# the residual force falls below force_tol, rather than on disp_tol,
+# which the adaptive schedule's damping meets early. kwargs are passed on
+# to run_headless
+def compare_schedules(nodes, edges, dt, is_tree=False, root=None, force_tol=600, **kwargs):
+    nodes = list(nodes)
+    kwargs = dict(kwargs, force_tol=force_tol, disp_tol=None)
+    start = [(tuple(node.pos), tuple(node.velocity)) for node in nodes]
+    results = []
+    for adaptive in (False, True):
+        for node, (pos, velocity) in zip(nodes, start):
+            node.pos, node.velocity = Vector(*pos), Vector(*velocity)
+        coords, steps = run_headless(nodes, edges, dt, is_tree, root, adaptive=adaptive, **kwargs)
+        state = arrayfdl.ArrayGraph(nodes, edges, root if is_tree else None)
+        results.append((steps, graph_residual(state, kwargs.get('bh'), kwargs.get('theta', .25))))
+    (fixed_steps, fixed_residual), (adaptive_steps, adaptive_residual) = results
+    return fixed_steps, adaptive_steps, fixed_residual, adaptive_residual, coords
+
+# write a layout as lines of "index,name,x,y"
+def write_layout(out_file, nodes, coords):
+    for i, (node, (x, y)) in enumerate(zip(nodes, coords)):
+        name = to_ascii(getattr(node, 'name', '')).replace(',', ' ')
+        out_file.write('{0},{1},{2},{3}\n'.format(i, name, x, y))
+
+# set up the nodes of a graph for a layout, seeding a tree as args.seed asks
+def start(nodes, root, args):
+    if root is not None and args.seed != 'random':
+        seed_tree(root, args.width, args.charge, args.seed == 'radial')
+    else:
+        initialize(nodes, args.width, args.charge)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Lay out graphs without a display.')
+    parser.add_argument('graphs', nargs='+',
+                        help='"bin:LEVELS", "com:N" or the path of a saved friend graph')
+    parser.add_argument('--dt', type=float, default=.01)
+    parser.add_argument('--width', type=int, default=500)
+    parser.add_argument('--charge', type=float, default=300)
+    parser.add_argument('--engine', choices=['numpy', 'python'], default='numpy')
+    parser.add_argument('--bh', action='store_true', help='use the Barnes-Hut approximation')
+    parser.add_argument('--multilevel', action='store_true',
+                        help='lay out a hierarchy of coarsened graphs, coarsest first')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='adapt the time-step and damping to the progress of the layout')
+    parser.add_argument('--compare', action='store_true',
+                        help='also run the fixed schedule and report the steps adaptive saved')
+    parser.add_argument('--seed', choices=['random', 'tidy', 'radial'], default='random',
+                        help='start a tree from a tidy or radial drawing instead of random positions')
+    parser.add_argument('--theta', type=float, default=.25)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--max-steps', type=int, default=5000)
+    parser.add_argument('--energy-tol', type=float, default=None)
+    parser.add_argument('--disp-tol', type=float, default=1.5)
+    parser.add_argument('--force-tol', type=float, default=None,
+                        help='stop once the mean net force on a node falls below FORCE_TOL')
+    parser.add_argument('--compare-force-tol', type=float, default=600,
+                        help='the residual force both schedules settle to with --compare')
+    parser.add_argument('--out-dir', default=None,
+                        help='write each layout to OUT_DIR/<graph>.csv instead of stdout')
+    args = parser.parse_args(argv)
+
+    for spec in args.graphs:
+        nodes, edges, root = load_graph(spec)
+        if args.multilevel:
+            # multilevel imports this module for settle
+            from multilevel import multilevel_layout
+            coords = multilevel_layout(nodes, edges, args.dt, args.charge, args.width,
+                                       theta=args.theta)
+            sys.stderr.write('{0}: {1} nodes\n'.format(spec, len(nodes)))
+        elif args.compare:
+            start(nodes, root, args)
+            fixed_steps, steps, fixed_residual, residual, coords = compare_schedules(
+                nodes, edges, args.dt, root is not None, root, args.compare_force_tol,
+                engine=args.engine, bh=args.bh, max_steps=args.max_steps,
+                energy_tol=args.energy_tol, processes=args.processes, theta=args.theta)
+            sys.stderr.write('{0}: {1} nodes, {2} steps fixed (residual force {3:.0f}), '
+                             '{4} steps adaptive (residual force {5:.0f}), {6} saved\n'
+                             .format(spec, len(nodes), fixed_steps, fixed_residual, steps,
+                                     residual, fixed_steps - steps))
+        else:
+            start(nodes, root, args)
+            coords, steps = run_headless(nodes, edges, args.dt, root is not None, root,
+                                         args.engine, args.bh, args.max_steps,
+                                         args.energy_tol, args.disp_tol, args.processes,
+                                         args.theta, args.adaptive, args.force_tol)
+            sys.stderr.write('{0}: {1} nodes, {2} steps\n'.format(spec, len(nodes), steps))
+        if args.out_dir:
+            name = os.path.basename(spec).replace(':', '_') + '.csv'
+            with open(os.path.join(args.out_dir, name), 'w') as out_file:
+                write_layout(out_file, nodes, coords)
+        else:
+            write_layout(sys.stdout, nodes, coords)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,86 @@
+import numpy as np
+from fdl import *
+import arrayfdl
+from graphstore import csr_adjacency
+from layout import settle
+
+# pair each node with an unmatched neighbour, visiting the nodes in a
+# random order and preferring the lightest neighbour so that coarse
+# nodes stay evenly sized. Returns the coarse node of every node and the
+# number of coarse nodes
+def match(n, src, dst, weight, rs):
+    indptr, neighbours = csr_adjacency(n, src, dst)
+    indptr, neighbours, weight = indptr.tolist(), neighbours.tolist(), weight.tolist()
+    coarse = [-1] * n
+    ncoarse = 0
+    for v in rs.permutation(n).tolist():
+        if coarse[v] >= 0:
+            continue
+        best = -1
+        for u in neighbours[indptr[v]:indptr[v + 1]]:
+            if coarse[u] < 0 and u != v and (best < 0 or weight[u] < weight[best]):
+                best = u
+        coarse[v] = ncoarse
+        if best >= 0:
+            coarse[best] = ncoarse
+        ncoarse += 1
+    return np.array(coarse, dtype=np.intp), ncoarse
+
+# merge matched nodes into one coarser level. Charges and weights (the
+# number of original nodes a node stands for) add up, and each pair of
+# coarse nodes joined by any edge gets a single edge
+def coarsen(n, src, dst, charge, weight, rs):
+    coarse, ncoarse = match(n, src, dst, weight, rs)
+    a, b = coarse[src], coarse[dst]
+    keep = a != b
+    lo, hi = np.minimum(a[keep], b[keep]), np.maximum(a[keep], b[keep])
+    pairs = np.unique(lo * ncoarse + hi)
+    return (coarse, ncoarse, pairs // ncoarse, pairs % ncoarse,
+            np.bincount(coarse, weights=charge, minlength=ncoarse),
+            np.bincount(coarse, weights=weight, minlength=ncoarse))
+
+
+# lay out a graph by repeatedly coarsening it, laying out the smallest
+# level from random positions with the usual force model, then placing
+# each finer level's nodes at their coarse node's position (plus a little
+# jitter to separate merged pairs) and refining with a short simulation.
+# Coarsening stops at min_nodes or when a level shrinks by less than
+# min_shrink. Levels larger than bh_nodes use the Barnes-Hut
+# approximation. Takes the same nodes and edges as run_simulation, sets
+# up the nodes as initialize does, and returns the final positions as a
+# list of (x, y) tuples in the order of nodes
+def multilevel_layout(nodes, edges, dt=.01, charge=100, width=500, min_nodes=50,
+                      min_shrink=.1, coarsest_steps=2000, refine_steps=300,
+                      bh_nodes=1000, theta=.25, seed=None):
+    nodes, edges = list(nodes), list(edges)
+    initialize(nodes, width, charge)
+    rs = np.random.RandomState(seed)
+    index = dict((node, i) for i, node in enumerate(nodes))
+    n = len(nodes)
+    src = np.array([index[e[0]] for e in edges], dtype=np.intp)
+    dst = np.array([index[e[1]] for e in edges], dtype=np.intp)
+    charges = np.full(n, float(charge))
+    weight  = np.ones(n)
+
+    # levels[i] holds the edges and charges of level i and the coarse node
+    # each of its nodes was merged into
+    levels = []
+    while n > min_nodes:
+        coarse, ncoarse, csrc, cdst, ccharge, cweight = coarsen(n, src, dst, charges, weight, rs)
+        if ncoarse > (1 - min_shrink) * n:
+            break
+        levels.append((n, src, dst, charges, coarse))
+        n, src, dst, charges, weight = ncoarse, csrc, cdst, ccharge, cweight
+
+    pos = rs.randint(0, width + 1, size=(n, 2))
+    graph = arrayfdl.ArrayGraph.from_arrays(pos, charges, src, dst)
+    settle(graph, dt, n > bh_nodes, coarsest_steps, theta=theta)
+
+    for n, src, dst, charges, coarse in reversed(levels):
+        pos = graph.pos[coarse] + rs.uniform(-5, 5, size=(n, 2))
+        graph = arrayfdl.ArrayGraph.from_arrays(pos, charges, src, dst)
+        settle(graph, dt, n > bh_nodes, refine_steps, theta=theta)
+
+    for node, (x, y) in zip(nodes, graph.pos.astype(int).tolist()):
+        node.pos = Vector(x, y)
+    return [tuple(node.pos) for node in nodes]
@@ -0,0 +1,96 @@
+import multiprocessing
+import numpy as np
+from multiprocessing.sharedctypes import RawArray
+import arrayfdl
+from flatbh import FlatBHTree
+
+# The positions and charges a worker process sees, as views of the
+# pool's shared memory. It stands in for the ArrayGraph in the arrayfdl
+# force functions
+class SharedArrays(object):
+    def __init__(self, pos_buf, charge_buf, force_buf, n):
+        self.pos    = np.frombuffer(pos_buf).reshape(n, 2)
+        self.charge = np.frombuffer(charge_buf)
+        self.force  = np.frombuffer(force_buf).reshape(n, 2)
+        # the Barnes-Hut tree of the current step, and that step's number
+        self.tree, self.step = None, None
+
+# the worker's view of the shared arrays, set by init_worker
+shared = None
+
+def init_worker(pos_buf, charge_buf, force_buf, n):
+    global shared
+    shared = SharedArrays(pos_buf, charge_buf, force_buf, n)
+
+# fill in the coulomb forces on the nodes start to stop
+def coulomb_chunk(args):
+    start, stop, k = args
+    shared.force[start:stop] = arrayfdl.coulomb_rows(shared, np.arange(start, stop), k)
+    return stop - start
+
+# fill in the Barnes-Hut forces on the nodes start to stop, returning the
+# number of interactions evaluated. Each worker builds the tree from the
+# shared positions itself once per step, so no tree is ever sent between
+# processes
+def bh_chunk(args):
+    start, stop, step, theta, k = args
+    if shared.step != step:
+        shared.tree = FlatBHTree(shared.pos, shared.charge)
+        shared.step = step
+    shared.force[start:stop] = shared.tree.forces(k, theta, np.arange(start, stop))
+    return shared.tree.interactions
+
+
+# A pool of worker processes that evaluates the repulsive forces of an
+# ArrayGraph. Positions and charges are copied into shared memory once
+# per step and each worker writes the forces for its own chunk of nodes
+# into a shared array, which is added back into the graph's forces before
+# the velocities are updated. Creating a pool attaches it to the graph,
+# so arrayfdl.update_graph and flatbh.update_graph_bh use it
+class ForcePool(object):
+    def __init__(self, graph, processes=None, chunks_per_process=4):
+        n = len(graph)
+        self.graph = graph
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pos_buf    = RawArray('d', 2 * n)
+        self.charge_buf = RawArray('d', n)
+        self.force_buf  = RawArray('d', 2 * n)
+        self.shared = SharedArrays(self.pos_buf, self.charge_buf, self.force_buf, n)
+        self.pool = multiprocessing.Pool(self.processes, init_worker,
+                                         (self.pos_buf, self.charge_buf, self.force_buf, n))
+
+        nchunks = max(1, min(n, self.processes * chunks_per_process))
+        bounds = np.linspace(0, n, nchunks + 1).astype(int).tolist()
+        self.chunks = zip(bounds[:-1], bounds[1:])
+        self.step = 0
+        graph.pool = self
+
+    # copy the current positions and charges into shared memory
+    def publish(self):
+        self.shared.pos[:]    = self.graph.pos
+        self.shared.charge[:] = self.graph.charge
+        self.step += 1
+
+    # add the forces the workers left in shared memory to the free nodes
+    def collect(self):
+        free = ~self.graph.fixed
+        self.graph.force[free] += self.shared.force[free]
+
+    def update_coulomb_forces(self, k=100):
+        self.publish()
+        self.pool.map(coulomb_chunk, [(start, stop, k) for start, stop in self.chunks])
+        self.collect()
+
+    # returns the number of interactions evaluated
+    def update_forces_bh(self, theta=.25, k=100):
+        self.publish()
+        counts = self.pool.map(bh_chunk, [(start, stop, self.step, theta, k)
+                                          for start, stop in self.chunks])
+        self.collect()
+        return sum(counts)
+
+    # stop the workers and detach the pool from its graph
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.graph.pool = None
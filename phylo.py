@@ -1,7 +1,14 @@
 import os.path, urllib2
+import numpy as np
 from treeclasses import *
+from taxonomy import Taxonomy, load_cached
 from BeautifulSoup import BeautifulSoup as BS
 
+# the taxonomy loaded by load_taxonomy, and the nodes made from it by
+# generate_nodelist
+taxonomy = None
+nodelist = None
+
 def clean_name_file(namefile, outpath):
     f = open(outpath, 'w')
     f.close()
@@ -43,31 +50,89 @@ def read_nodes(nodefile, nodelist):
             pass
     return nodelist
 
-def lineage(node, acc=[]):
-    if node.name == 'root':
-        return acc
-    else:
-        return lineage(node.parent, acc + [node])
-
+# the ancestors of a node from the node itself up to, but not including,
+# the root
+def lineage(node):
+    res = []
+    while node.name != 'root':
+        res.append(node)
+        node = node.parent
+    return res
+
+# the taxonomy loaded by load_taxonomy; raises RuntimeError if none has
+# been
+def loaded_taxonomy():
+    if taxonomy is None:
+        raise RuntimeError('no taxonomy is loaded; call load_taxonomy or generate_nodelist first')
+    return taxonomy
+
+# the node of the taxon at a row of the loaded taxonomy, from nodelist if
+# generate_nodelist made one
+def node_at(row):
+    tax = loaded_taxonomy()
+    if nodelist is not None:
+        return nodelist[tax.tax_id[row]]
+    return tax.node(row)
+
+# the node of the taxon with the given scientific name, found through the
+# name index of the loaded taxonomy. The node comes from nodelist if
+# generate_nodelist made one, and is otherwise made along with its
+# lineage. Returns None for unknown names
 def node_by_name(name):
-    global nodelist
-    for node in nodelist:
-        if node:
-            if node.name == name:
-                return node
-
+    tax = loaded_taxonomy()
+    row = tax.index_names().row(name)
+    if row < 0:
+        return None
+    return node_at(row)
+
+# the names of at most limit taxa starting with prefix, ignoring case, in
+# alphabetical order, e.g. to complete a name as it is typed
+def names_starting_with(prefix, limit=10):
+    tax = loaded_taxonomy()
+    rows = tax.index_names().rows_by_prefix(prefix, limit)
+    return [tax.name(row) for row in rows.tolist()]
+
+def lineage_by_name(name):
+    node = node_by_name(name)
+    if node:
+        return lineage(node)
+
+# the most specific group two taxa share, as a node, or None if either
+# name is unknown
 def last_shared_group(name1, name2):
-    lineage1 = lineage_by_name(name1)
-    lineage2 = lineage_by_name(name2)
-    if lineage1 and lineage2:
-        for a1, a2 in zip(lineage1[::-1], lineage2[::-1]):
-            if a1 == a2:
-                mostrecent = a1
-            else:
-                break
-    else:
+    tax = loaded_taxonomy()
+    index = tax.index_names()
+    row1, row2 = index.row(name1), index.row(name2)
+    if row1 < 0 or row2 < 0:
+        return None
+    row = tax.index_ancestors().lca(row1, row2)
+    if row < 0:
         return None
-    return mostrecent
+    return node_at(row)
+
+# last_shared_group for each of a list of pairs of names, answered as one
+# batch
+def last_shared_groups(pairs):
+    tax = loaded_taxonomy()
+    index = tax.index_names()
+    rows = np.array([[index.row(name) for name in pair] for pair in pairs],
+                    dtype=np.int32).reshape(-1, 2)
+    known = (rows >= 0).all(axis=1)
+    groups = np.full(len(rows), -1, dtype=np.int32)
+    groups[known] = tax.index_ancestors().lca_rows(rows[known, 0], rows[known, 1])
+    return [node_at(row) if row >= 0 else None for row in groups.tolist()]
+
+# the tax ids of the most specific groups shared by every pair of the
+# given taxa, as a matrix; -1 marks unknown names
+def shared_group_matrix(names):
+    tax = loaded_taxonomy()
+    index = tax.index_names()
+    rows = np.array([index.row(name) for name in names], dtype=np.int32)
+    known = np.flatnonzero(rows >= 0)
+    res = np.full((len(rows), len(rows)), -1, dtype=np.int32)
+    groups = tax.index_ancestors().lca_matrix(rows[known])
+    res[np.ix_(known, known)] = np.where(groups >= 0, tax.tax_id[groups], -1)
+    return res
 
 def images_and_times(nodes):
     opener = urllib2.build_opener()
@@ -94,17 +159,35 @@ def nodes_to_html(nodes):
     name_cells  = ['<td>{0}: {1}</td>'.format(capitalize(node.name), time) for node,time in zip(nodes,times)]
     return '<table border="1">\n<tr>' + '\n'.join(img_cells) + '</tr>\n<tr>' + '\n'.join(name_cells) + '</tr>\n</table>'
 
-# The arguments are the paths (or in the case of clean_name_file_path,
-# possibly the desired path) to names.dmp, nodes.dmp, and the clean 
-# names file respectively
-def generate_nodelist(name_file_path, node_file_path, clean_name_file_path)
-    with open(node_file_path) as nodefile:
-        if not os.path.exists(clean_name_file_path):
-            with open(name_file_path) as dirty_file:
-                clean_name_file(dirty_file, clean_name_file_path)
-
-        with open (clean_name_file_path) as clean_file:
-            nodelist = read_nodes(nodefile, read_names(clean_file))
+# load the NCBI taxonomy from the paths to names.dmp and nodes.dmp into a
+# taxonomy.Taxonomy, streaming both files. Node objects are only made for
+# the subtrees asked for with taxonomy.subtree. Given a cache_path, the
+# parsed taxonomy is kept in a binary cache there and later loads map the
+# cache instead of parsing the dumps again, until the dumps change
+def load_taxonomy(name_file_path, node_file_path, cache_path=None):
+    global taxonomy
+    if cache_path is None:
+        taxonomy = Taxonomy.from_dumps(name_file_path, node_file_path)
+    else:
+        taxonomy = load_cached(name_file_path, node_file_path, cache_path)
+    return taxonomy
+
+# The arguments are the paths to names.dmp and nodes.dmp, and optionally
+# of a taxonomy cache as in load_taxonomy. Returns a list of the nodes of
+# the whole taxonomy indexed by tax id, as node_by_name expects. The
+# clean names file is no longer needed; the argument is only accepted for
+# old callers
+def generate_nodelist(name_file_path, node_file_path, clean_name_file_path=None, cache_path=None):
+    global nodelist
+    tax = load_taxonomy(name_file_path, node_file_path, cache_path)
+    nodelist = [None] * len(tax.rows)
+    for root in tax.roots().tolist():
+        stack = [tax.subtree(root)]
+        while stack:
+            node = stack.pop()
+            nodelist[node.id] = node
+            stack.extend(node.children)
+    return nodelist
 
 if __name__ == "__main__":
     print "This module is not intended to be called directly."
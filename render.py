@@ -0,0 +1,223 @@
+from itertools import repeat
+import numpy as np
+import pygame
+from graphstore import CompactGraph
+
+EDGE_COLOR = (0, 0, 255)
+NODE_COLOR = (255, 255, 255)
+
+# the screen positions of nodes as an (n, 2) array
+def screen_points(nodes):
+    points = [node.screen_pos for node in nodes]
+    return np.array([(p.x, p.y) for p in points], dtype=float).reshape(-1, 2)
+
+# which of the segments from a to b could cross the rectangle (left, top,
+# right, bottom): a segment with both ends beyond the same side cannot
+def crossing(a, b, rect):
+    left, top, right, bottom = rect
+    return ~(((a[:, 0] < left) & (b[:, 0] < left)) | ((a[:, 0] > right) & (b[:, 0] > right)) |
+             ((a[:, 1] < top) & (b[:, 1] < top)) | ((a[:, 1] > bottom) & (b[:, 1] > bottom)))
+
+# cover the edges of a graph on n nodes with trails, walks that use each
+# edge once, so that every trail can be drawn with one pygame.draw.lines
+# call instead of one pygame.draw.line per edge. Walks start from the
+# nodes of odd degree, where trails must end, and then from the rest.
+# Returns the node sequence of the trails one after another and where
+# each starts in it, followed by the length of the sequence
+def edge_trails(n, src, dst):
+    m = len(src)
+    ends = np.concatenate([src, dst])
+    order = np.argsort(ends, kind='mergesort')
+    others = np.concatenate([dst, src])[order].tolist()
+    edge_ids = np.concatenate([np.arange(m), np.arange(m)])[order].tolist()
+    degree = np.bincount(ends, minlength=n)
+    indptr = np.concatenate([[0], np.cumsum(degree)])
+    next_edge, stop = indptr[:-1].tolist(), indptr[1:].tolist()
+    unused = degree.tolist()
+    used = [False] * m
+    sequence, starts = [], []
+    for v in np.concatenate([np.flatnonzero(degree % 2 == 1),
+                             np.flatnonzero((degree % 2 == 0) & (degree > 0))]).tolist():
+        while unused[v]:
+            starts.append(len(sequence))
+            sequence.append(v)
+            u = v
+            while True:
+                i = next_edge[u]
+                while i < stop[u] and used[edge_ids[i]]:
+                    i += 1
+                next_edge[u] = i
+                if i == stop[u]:
+                    break
+                used[edge_ids[i]] = True
+                w = others[i]
+                unused[u] -= 1
+                unused[w] -= 1
+                sequence.append(w)
+                u = w
+    starts.append(len(sequence))
+    return np.array(sequence, dtype=np.intp), np.array(starts, dtype=np.intp)
+
+# draw trails from edge_trails, leaving out the segments wholly outside
+# the rectangle rect; a trail is split into a polyline per run of segments
+# that are left in
+def draw_trails(screen, points, sequence, starts, rect, color=EDGE_COLOR):
+    if not len(sequence):
+        return
+    path = points[sequence]
+    keep = crossing(path[:-1], path[1:], rect)
+    # the segments joining the end of one trail to the start of the next
+    keep[starts[1:-1] - 1] = False
+    change = np.diff(np.concatenate([[0], keep.view(np.int8), [0]]))
+    runs = zip(np.flatnonzero(change == 1).tolist(), np.flatnonzero(change == -1).tolist())
+    path = path.astype(int).tolist()
+    for start, stop in runs:
+        pygame.draw.lines(screen, color, False, path[start:stop + 1])
+
+# shade the screen by how many edges pass through each cell x cell
+# square, on a log scale. Each edge is sampled at up to max_samples evenly
+# spaced points, fewer when there are so many edges that the samples would
+# pass budget, so that the cost of a frame stays bounded
+def draw_density(screen, points, src, dst, color=EDGE_COLOR, cell=4, max_samples=8,
+                 budget=1 << 18, block_size=1 << 16):
+    width, height = screen.get_size()
+    cols, rows = width // cell + 1, height // cell + 1
+    counts = np.zeros(cols * rows)
+    samples = max(1, min(max_samples, budget // max(len(src), 1)))
+    t = (np.arange(samples) + .5) / samples
+    for start in xrange(0, len(src), block_size):
+        a, b = points[src[start:start + block_size]], points[dst[start:start + block_size]]
+        x = ((a[:, 0, np.newaxis] + (b - a)[:, 0, np.newaxis] * t) // cell).astype(int).ravel()
+        y = ((a[:, 1, np.newaxis] + (b - a)[:, 1, np.newaxis] * t) // cell).astype(int).ravel()
+        inside = (x >= 0) & (x < cols) & (y >= 0) & (y < rows)
+        counts += np.bincount(x[inside] * rows + y[inside], minlength=cols * rows)
+    if not counts.any():
+        return
+    shade = np.log1p(counts) / np.log1p(counts.max())
+    rgb = (shade[:, np.newaxis] * color).astype(np.uint8).reshape(cols, rows, 3)
+    heat = pygame.transform.scale(pygame.surfarray.make_surface(rgb), (cols * cell, rows * cell))
+    # the empty cells are left as they were
+    heat.set_colorkey((0, 0, 0))
+    screen.blit(heat, (0, 0))
+
+
+# Draws graphs onto a pygame surface with as few drawing calls as
+# possible. Edges are drawn as the polylines of edge_trails, which are
+# worked out once per set of edges, and nodes are blitted from one
+# prerendered circle in a single Surface.blits call. Anything wholly off
+# the screen is culled. Past max_edges visible edges the edges are drawn
+# as a density heat map instead, and past max_nodes visible nodes each
+# node is a single pixel, so that very large or dense graphs stay
+# interactive. For a list of edge tuples that grows between frames (as
+# while a friend graph downloads), only the new edges are converted and
+# they get trails of their own
+class Renderer(object):
+    def __init__(self, screen, radius=10, edge_color=EDGE_COLOR, node_color=NODE_COLOR,
+                 max_edges=20000, max_nodes=10000, cell=4):
+        self.screen = screen
+        self.radius = radius
+        self.edge_color, self.node_color = edge_color, node_color
+        self.max_edges, self.max_nodes = max_edges, max_nodes
+        self.cell = cell
+        size = 2 * radius + 1
+        # in the screen's pixel format (and palette, on an 8-bit display),
+        # or the colour key and node colour may not survive the blit
+        self.sprite = pygame.Surface((size, size), 0, screen)
+        if screen.get_bitsize() == 8:
+            self.sprite.set_palette(screen.get_palette())
+        key = (0, 0, 0) if node_color != (0, 0, 0) else (255, 0, 255)
+        self.sprite.fill(key)
+        self.sprite.set_colorkey(key)
+        pygame.draw.circle(self.sprite, node_color, (radius, radius), radius)
+        # the edges last drawn, how many of them have been converted, the
+        # nodes they index into, and the index arrays and trails so far
+        self.edges, self.converted = None, 0
+        self.nodes, self.index = None, None
+        self.src, self.dst = np.empty(0, np.intp), np.empty(0, np.intp)
+        self.sequence, self.starts = np.empty(0, np.intp), np.zeros(1, np.intp)
+
+    # the bounds of the screen, widened by the node radius
+    def bounds(self):
+        width, height = self.screen.get_size()
+        r = self.radius
+        return -r, -r, width + r, height + r
+
+    # bring the index arrays and trails up to date with a graph's edges. A
+    # CompactGraph has its own nodes; the edges of a list of node tuples
+    # index into nodes, or into the nodes they touch in order of appearance
+    def convert(self, edges, nodes=None):
+        if isinstance(edges, CompactGraph):
+            nodes = edges.nodes
+        same = edges is self.edges and (nodes is None or nodes is self.nodes)
+        if same and self.converted == len(edges):
+            return
+        if not (same and isinstance(edges, list) and self.converted < len(edges)):
+            self.edges, self.converted = edges, 0
+            self.nodes = nodes if nodes is not None else []
+            self.index = None if isinstance(edges, CompactGraph) else \
+                dict((node, i) for i, node in enumerate(self.nodes))
+            self.src, self.dst = np.empty(0, np.intp), np.empty(0, np.intp)
+            self.sequence, self.starts = np.empty(0, np.intp), np.zeros(1, np.intp)
+
+        if isinstance(edges, CompactGraph):
+            src, dst = edges.src.astype(np.intp), edges.dst.astype(np.intp)
+        else:
+            index, grow = self.index, nodes is None
+            src, dst = [], []
+            for a, b in (edges[self.converted:] if self.converted else edges):
+                for node in (a, b):
+                    if grow and node not in index:
+                        index[node] = len(self.nodes)
+                        self.nodes.append(node)
+                src.append(index[a])
+                dst.append(index[b])
+            src, dst = np.array(src, dtype=np.intp), np.array(dst, dtype=np.intp)
+        sequence, starts = edge_trails(len(self.nodes), src, dst)
+        self.starts = np.concatenate([self.starts[:-1], starts + len(self.sequence)])
+        self.sequence = np.concatenate([self.sequence, sequence])
+        self.src, self.dst = np.concatenate([self.src, src]), np.concatenate([self.dst, dst])
+        self.converted = len(edges)
+
+    def draw_edges(self, edges, nodes=None, points=None):
+        self.convert(edges, nodes)
+        if points is None:
+            points = screen_points(self.nodes)
+        rect = self.bounds()
+        if len(self.src) > self.max_edges:
+            keep = crossing(points[self.src], points[self.dst], rect)
+            if keep.sum() > self.max_edges:
+                draw_density(self.screen, points, self.src[keep], self.dst[keep],
+                             self.edge_color, self.cell)
+                return
+        draw_trails(self.screen, points, self.sequence, self.starts, rect, self.edge_color)
+
+    def draw_nodes(self, nodes, points=None):
+        if points is None:
+            points = screen_points(nodes)
+        left, top, right, bottom = self.bounds()
+        visible = ((points[:, 0] >= left) & (points[:, 0] <= right) &
+                   (points[:, 1] >= top) & (points[:, 1] <= bottom))
+        points = points[visible].astype(int)
+        if len(points) > self.max_nodes:
+            width, height = self.screen.get_size()
+            x, y = points[:, 0], points[:, 1]
+            inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            pixels = pygame.surfarray.pixels2d(self.screen)
+            pixels[x[inside], y[inside]] = self.screen.map_rgb(self.node_color)
+            del pixels
+        else:
+            corners = (points - self.radius).tolist()
+            self.screen.blits(zip(repeat(self.sprite, len(corners)), corners), False)
+
+    # draw a graph's edges and then its nodes, at points (an (n, 2) array
+    # in the order of nodes) rather than the nodes' screen positions if
+    # given
+    def draw(self, nodes, edges, points=None):
+        nodes = nodes if isinstance(nodes, list) else list(nodes)
+        if points is None:
+            points = screen_points(nodes)
+        if isinstance(edges, CompactGraph) and edges.nodes is not nodes:
+            self.draw_edges(edges)
+        else:
+            self.draw_edges(edges, nodes, points)
+        self.draw_nodes(nodes, points)
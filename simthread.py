@@ -0,0 +1,83 @@
+import threading
+import Queue
+import time
+import arrayfdl, flatbh
+
+# Steps an arrayfdl.ArrayGraph continuously in a background thread, so
+# that drawing and event handling never wait on the physics and the
+# physics never waits on drawing. After each step the positions are
+# copied into the back one of two buffers, which then becomes the front
+# one; snapshot hands out a copy of the front buffer, so a reader always
+# sees the positions of one whole step. Pins and unpins (e.g. from
+# dragging a node) are queued with pin and unpin and applied between
+# steps. rate, if given, holds the simulation to that many steps a
+# second; bh approximates the coulomb forces with a Barnes-Hut tree
+class SimulationThread(threading.Thread):
+    def __init__(self, graph, dt, rate=None, bh=False, theta=.25):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.graph, self.dt = graph, dt
+        self.rate = rate
+        self.bh, self.theta = bh, theta
+        self.buffers = [graph.pos.copy(), graph.pos.copy()]
+        self.front = 0
+        self.steps = 0
+        self.lock = threading.Lock()
+        self.commands = Queue.Queue()
+        self.stopped = threading.Event()
+
+    def step(self):
+        if self.bh:
+            flatbh.update_graph_bh(self.graph, self.dt, self.theta)
+        else:
+            arrayfdl.update_graph(self.graph, self.dt)
+
+    # copy the positions into the back buffer and swap it to the front
+    def publish(self):
+        back = 1 - self.front
+        self.buffers[back][:] = self.graph.pos
+        with self.lock:
+            self.front = back
+            self.steps += 1
+
+    # the positions after the latest step, and the number of that step
+    def snapshot(self):
+        with self.lock:
+            return self.buffers[self.front].copy(), self.steps
+
+    # hold a node at pos (in simulation coordinates) until it is unpinned
+    def pin(self, node, pos):
+        self.commands.put(('pin', node, pos))
+
+    def unpin(self, node):
+        self.commands.put(('unpin', node, None))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def apply_commands(self):
+        while True:
+            try:
+                command, node, pos = self.commands.get_nowait()
+            except Queue.Empty:
+                return
+            if command == 'pin':
+                self.graph.pin(node, pos)
+            else:
+                self.graph.unpin(node)
+
+    def run(self):
+        interval = 1.0 / self.rate if self.rate else 0
+        next_step = time.time()
+        while not self.stopped.is_set():
+            self.apply_commands()
+            self.step()
+            self.publish()
+            if interval:
+                next_step += interval
+                delay = next_step - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_step = time.time()
@@ -0,0 +1,83 @@
+import numpy as np
+
+# A uniform grid over a set of points (such as the nodes' screen
+# positions), for finding the points in a rectangle, within a distance of
+# a point, or nearest to one without looking at every point. The points
+# are sorted by the cell they fall in, column by column, so the points of
+# a run of cells in one column are a single slice of order. Cells are
+# cell wide, or wider if that would make many more cells than points.
+# The grid is not updated as the points move; build a new one each frame
+class SpatialGrid(object):
+    def __init__(self, points, cell=20):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        n = len(self.points)
+        if n:
+            self.low, self.high = self.points.min(axis=0), self.points.max(axis=0)
+        else:
+            self.low = self.high = np.zeros(2)
+        extent = self.high - self.low
+        # no more than a few cells per point, however the points are
+        # spread: widen the cells until the grid is small enough
+        self.cell = float(cell)
+        max_cells = 4 * max(n, 1)
+        while np.prod(extent // self.cell + 1) > max_cells:
+            self.cell = max(self.cell * 2, np.sqrt(extent[0] * extent[1] / max_cells))
+        self.cols, self.rows = (extent // self.cell).astype(int) + 1
+        cx, cy = ((self.points - self.low) // self.cell).astype(int).T
+        cells = cx * self.rows + cy
+        # stable, so the points in each cell stay in index order
+        self.order = np.argsort(cells, kind='mergesort')
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=self.cols * self.rows))])
+
+    def __len__(self):
+        return len(self.points)
+
+    # the indices of the points in the cells that meet a rectangle, some
+    # of which may lie outside it
+    def candidates(self, left, top, right, bottom):
+        c0, r0 = np.maximum(((left - self.low[0]) // self.cell, (top - self.low[1]) // self.cell), 0)
+        c1 = min((right - self.low[0]) // self.cell, self.cols - 1)
+        r1 = min((bottom - self.low[1]) // self.cell, self.rows - 1)
+        if c0 > c1 or r0 > r1:
+            return np.empty(0, dtype=np.intp)
+        c0, r0, c1, r1 = int(c0), int(r0), int(c1), int(r1)
+        starts, order = self.starts, self.order
+        return np.concatenate([order[starts[c * self.rows + r0]:starts[c * self.rows + r1 + 1]]
+                               for c in xrange(c0, c1 + 1)])
+
+    # the indices, in ascending order, of the points in the rectangle
+    # (left, top, right, bottom), edges included
+    def rect(self, left, top, right, bottom):
+        found = self.candidates(left, top, right, bottom)
+        x, y = self.points[found, 0], self.points[found, 1]
+        return np.sort(found[(x >= left) & (x <= right) & (y >= top) & (y <= bottom)])
+
+    # the indices of the points within radius of (x, y), nearest first
+    def point(self, x, y, radius):
+        found = self.candidates(x - radius, y - radius, x + radius, y + radius)
+        dist = np.hypot(self.points[found, 0] - x, self.points[found, 1] - y)
+        order = np.argsort(dist, kind='mergesort')
+        return found[order][dist[order] <= radius]
+
+    # the index of the point nearest to (x, y), or None if there is none
+    # within max_distance. The square searched doubles in size until it
+    # holds a point no further away than its edges
+    def nearest(self, x, y, max_distance=None):
+        if not len(self):
+            return None
+        half = self.cell
+        # the distance at which the square covers every point
+        reach = max(abs(x - self.low[0]), abs(x - self.high[0]),
+                    abs(y - self.low[1]), abs(y - self.high[1]))
+        while True:
+            found = self.candidates(x - half, y - half, x + half, y + half)
+            if len(found):
+                dist = np.hypot(self.points[found, 0] - x, self.points[found, 1] - y)
+                best = dist.argmin()
+                if dist[best] <= half or half >= reach:
+                    if max_distance is not None and dist[best] > max_distance:
+                        return None
+                    return int(found[best])
+            if half >= reach or (max_distance is not None and half >= max_distance):
+                return None
+            half *= 2
@@ -0,0 +1,552 @@
+import os, mmap, json, struct, hashlib
+from bisect import bisect_left, bisect_right
+import numpy as np
+from treeclasses import *
+
+# the dump files are read this many bytes at a time
+CHUNK_SIZE = 1 << 22
+
+# the layout version of the files written by Taxonomy.save; files of any
+# other version are treated as stale
+CACHE_VERSION = 1
+CACHE_MAGIC = 'NCBITAX\0'
+
+# the fields of a dump line are separated by tab, bar, tab and the line
+# ends with tab, bar, newline; fields never contain tabs
+TAB, NEWLINE = ord('\t'), ord('\n')
+
+# the chunks of a dump file, chunk_size bytes at a time cut back to whole
+# lines, as byte arrays. Also yields the bounds of the fields of every
+# line in the chunk: the start of each line and the positions of its
+# tabs, one row per line
+def dump_chunks(dump_file, chunk_size=CHUNK_SIZE):
+    rest = ''
+    while True:
+        chunk = dump_file.read(chunk_size)
+        if not chunk:
+            if not rest:
+                break
+            chunk = '\n'
+        end = chunk.rfind('\n') + 1
+        if end == 0:
+            rest += chunk
+            continue
+        buf = np.frombuffer(rest + chunk[:end], dtype=np.uint8)
+        rest = chunk[end:]
+
+        newlines = np.flatnonzero(buf == NEWLINE)
+        line_starts = np.concatenate([[0], newlines[:-1] + 1])
+        tabs = np.flatnonzero(buf == TAB)
+        if len(tabs) % len(newlines):
+            raise ValueError('lines of a taxonomy dump have differing numbers of fields')
+        yield buf, line_starts, tabs.reshape(len(newlines), -1)
+
+# the start and end of field k of every line of a chunk
+def field_bounds(line_starts, tabs, k):
+    if k == 0:
+        return line_starts, tabs[:, 0]
+    return tabs[:, 2 * k - 1] + 1, tabs[:, 2 * k]
+
+# the characters of buf[start:end] for each start and end, as the rows
+# of a byte array padded with zeros
+def gather_chars(buf, start, end):
+    width = max(1, (end - start).max() if len(start) else 1)
+    cols = start[:, np.newaxis] + np.arange(width)
+    return np.where(cols < end[:, np.newaxis], buf[np.minimum(cols, len(buf) - 1)], 0).astype(np.uint8)
+
+# the decimal integers held in buf[start:end] for each start and end
+def parse_ints(buf, start, end):
+    chars = gather_chars(buf, start, end)
+    places = (end - start)[:, np.newaxis] - 1 - np.arange(chars.shape[1])
+    digits = np.where(places >= 0, chars.astype(np.int64) - ord('0'), 0)
+    return (digits * 10 ** np.maximum(places, 0)).sum(axis=1)
+
+# the strings held in buf[start:end] as a numpy string array
+def parse_strings(buf, start, end):
+    chars = gather_chars(buf, start, end)
+    return chars.view('S{0}'.format(chars.shape[1])).ravel()
+
+# the bytes of buf[start:end] for each start and end, joined into one string
+def join_spans(buf, start, end):
+    length = end - start
+    offset = np.repeat(start - np.concatenate([[0], np.cumsum(length)[:-1]]), length)
+    return buf[offset + np.arange(len(offset))].tostring()
+
+# read the tax ids, parent tax ids and ranks from nodes.dmp. Ranks are
+# stored as codes into the returned list of rank names
+def read_node_columns(nodefile):
+    ids, parents, codes = [], [], []
+    kinds, kind_code = [], {}
+    for buf, line_starts, tabs in dump_chunks(nodefile):
+        ids.append(parse_ints(buf, *field_bounds(line_starts, tabs, 0)))
+        parents.append(parse_ints(buf, *field_bounds(line_starts, tabs, 1)))
+        ranks, inverse = np.unique(parse_strings(buf, *field_bounds(line_starts, tabs, 2)),
+                                   return_inverse=True)
+        for rank in ranks.tolist():
+            if rank not in kind_code:
+                kind_code[rank] = len(kinds)
+                kinds.append(rank)
+        chunk_codes = np.array([kind_code[rank] for rank in ranks.tolist()], dtype=np.uint8)
+        codes.append(chunk_codes[inverse])
+    return (np.concatenate(ids).astype(np.int32), np.concatenate(parents).astype(np.int32),
+            np.concatenate(codes), kinds)
+
+# read the scientific names from names.dmp. Returns the tax id and the
+# length of each name, and the names joined into a single string
+def read_name_columns(namefile):
+    ids, lengths, blobs = [], [], []
+    for buf, line_starts, tabs in dump_chunks(namefile):
+        scientific = parse_strings(buf, *field_bounds(line_starts, tabs, 3)) == 'scientific name'
+        start, end = field_bounds(line_starts, tabs, 1)
+        start, end = start[scientific], end[scientific]
+        ids.append(parse_ints(buf, *field_bounds(line_starts[scientific], tabs[scientific], 0)))
+        lengths.append(end - start)
+        blobs.append(join_spans(buf, start, end))
+    return (np.concatenate(ids).astype(np.int32), np.concatenate(lengths).astype(np.int32),
+            ''.join(blobs))
+
+
+# the size, modification time and sha1 of a file, which identify the
+# dump a cache was built from
+def fingerprint(path, chunk_size=CHUNK_SIZE):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(chunk_size), ''):
+            sha1.update(chunk)
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+
+# whether a file still matches its fingerprint. A file of the same size
+# whose modification time changed is only hashed again to tell whether
+# it was rewritten or just touched
+def matches(path, print_):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != print_['size']:
+        return False
+    return stat.st_mtime == print_['mtime'] or fingerprint(path)['sha1'] == print_['sha1']
+
+
+# The NCBI taxonomy held as columns of compact arrays rather than one Node
+# per taxon. Each taxon is a row, in the order of nodes.dmp; parent holds
+# the parent's row (-1 for the root), kind a code into kinds, and the
+# taxon's scientific name is names[name_start:name_start + name_length].
+# The children of a row are children[child_start[row]:child_start[row + 1]].
+# Node objects are only made, by subtree, for the parts of the tree a
+# caller asks for
+class Taxonomy(object):
+    # the arrays saved in a cache file, in order
+    columns = ('tax_id', 'parent', 'kind', 'name_start', 'name_length',
+               'rows', 'child_start', 'children')
+
+    def __init__(self, tax_id, parent, kind, kinds, name_start, name_length, names,
+                 child_start=None, children=None, rows=None, name_index=None):
+        self.tax_id, self.parent = tax_id, parent
+        self.kind, self.kinds = kind, kinds
+        self.name_start, self.name_length, self.names = name_start, name_length, names
+
+        if rows is None:
+            rows = np.full(tax_id.max() + 1 if len(tax_id) else 0, -1, dtype=np.int32)
+            rows[tax_id] = np.arange(len(tax_id), dtype=np.int32)
+        self.rows = rows
+
+        if child_start is None:
+            has_parent = np.flatnonzero(parent >= 0)
+            order = np.argsort(parent[has_parent], kind='mergesort')
+            children = has_parent[order].astype(np.int32)
+            counts = np.bincount(parent[has_parent], minlength=len(parent))
+            child_start = np.concatenate([[0], np.cumsum(counts)])
+        self.child_start, self.children = child_start, children
+        # the NameIndex made by index_names and the AncestorIndex made by
+        # index_ancestors, if any
+        self.name_index = name_index
+        self.ancestor_index = None
+
+    # a Taxonomy from the nodes.dmp and names.dmp files of an NCBI
+    # taxonomy dump, streamed in chunks
+    @classmethod
+    def from_dumps(cls, name_file_path, node_file_path):
+        with open(node_file_path, 'rb') as nodefile:
+            tax_id, parent_id, kind, kinds = read_node_columns(nodefile)
+        with open(name_file_path, 'rb') as namefile:
+            name_id, name_length, names = read_name_columns(namefile)
+
+        rows = np.full(max(tax_id.max(), parent_id.max()) + 1, -1, dtype=np.int32)
+        rows[tax_id] = np.arange(len(tax_id), dtype=np.int32)
+        # the root is its own parent in the dumps
+        parent = np.where(parent_id == tax_id, -1, rows[parent_id]).astype(np.int32)
+
+        known = name_id < len(rows)
+        name_rows = np.full(len(name_id), -1, dtype=np.int32)
+        name_rows[known] = rows[name_id[known]]
+        starts = np.concatenate([[0], np.cumsum(name_length)[:-1]]).astype(np.int64)
+        named = name_rows >= 0
+        row_start = np.zeros(len(tax_id), dtype=np.int64)
+        row_length = np.zeros(len(tax_id), dtype=np.int32)
+        row_start[name_rows[named]] = starts[named]
+        row_length[name_rows[named]] = name_length[named]
+        return cls(tax_id, parent, kind, kinds, row_start, row_length, names)
+
+    # write the taxonomy to a binary cache file: a header giving the cache
+    # version, the fingerprints of the source files and where each column
+    # lies, then the columns and the names, each aligned to 8 bytes. The
+    # file is written under a temporary name and moved into place. Raises
+    # IOError rather than replace a file at path that is not a cache
+    def save(self, path, sources=()):
+        if os.path.exists(path):
+            with open(path, 'rb') as in_file:
+                if in_file.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                    raise IOError('{0} is not a taxonomy cache'.format(path))
+        arrays = [(column, getattr(self, column)) for column in self.columns]
+        if self.name_index is not None:
+            arrays += [(column, getattr(self.name_index, column)) for column in NameIndex.columns]
+        offset, layout = 0, []
+        for column, array in arrays:
+            array = np.ascontiguousarray(array)
+            layout.append((column, array.dtype.str, offset, len(array)))
+            offset += -(-array.nbytes // 8) * 8
+        header = json.dumps({'kinds': self.kinds, 'columns': layout,
+                             'names': [offset, len(self.names)],
+                             'sources': [fingerprint(source) for source in sources]})
+
+        with open(path + '.tmp', 'wb') as out_file:
+            out_file.write(CACHE_MAGIC + struct.pack('<II', CACHE_VERSION, len(header)))
+            out_file.write(header)
+            out_file.write('\0' * (-out_file.tell() % 8))
+            for column, array in arrays:
+                data = np.ascontiguousarray(array).tostring()
+                out_file.write(data + '\0' * (-len(data) % 8))
+            out_file.write(self.names)
+        os.rename(path + '.tmp', path)
+
+    # a Taxonomy whose columns are read-only views of a memory-mapped
+    # cache file, or None if the file is missing, of another version, or
+    # was built from source files that have since changed
+    @classmethod
+    def open(cls, path, sources=()):
+        try:
+            in_file = open(path, 'rb')
+        except IOError:
+            return None
+        with in_file:
+            start = in_file.read(len(CACHE_MAGIC) + 8)
+            if len(start) < len(CACHE_MAGIC) + 8 or not start.startswith(CACHE_MAGIC):
+                return None
+            version, header_size = struct.unpack('<II', start[len(CACHE_MAGIC):])
+            if version != CACHE_VERSION:
+                return None
+            header = json.loads(in_file.read(header_size))
+            if len(header['sources']) != len(sources) or not all(
+                    matches(source, print_) for source, print_ in zip(sources, header['sources'])):
+                return None
+            data_start = -(-in_file.tell() // 8) * 8
+            buf = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        columns = dict((column, np.frombuffer(buf, np.dtype(dtype), count, data_start + offset))
+                       for column, dtype, offset, count in header['columns'])
+        names_offset, names_size = header['names']
+        names = buffer(buf, data_start + names_offset, names_size)
+        kinds = [kind.encode('utf-8') for kind in header['kinds']]
+        tax = cls(columns['tax_id'], columns['parent'], columns['kind'], kinds,
+                  columns['name_start'], columns['name_length'], names,
+                  columns['child_start'], columns['children'], columns['rows'])
+        if 'name_table' in columns:
+            tax.name_index = NameIndex(tax, *[columns[column] for column in NameIndex.columns])
+        return tax
+
+    def __len__(self):
+        return len(self.tax_id)
+
+    # the NameIndex of the taxonomy, made on first use
+    def index_names(self):
+        if self.name_index is None:
+            self.name_index = NameIndex(self)
+        return self.name_index
+
+    # the AncestorIndex of the taxonomy, made on first use
+    def index_ancestors(self):
+        if self.ancestor_index is None:
+            self.ancestor_index = AncestorIndex(self)
+        return self.ancestor_index
+
+    # the depth of every row below its root, found a level at a time
+    def depths(self):
+        depth = np.zeros(len(self), dtype=np.int32)
+        level, rows = 0, self.roots()
+        while len(rows):
+            depth[rows] = level
+            starts, stops = self.child_start[rows], self.child_start[rows + 1]
+            counts = stops - starts
+            offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+            rows = self.children[offsets + np.arange(len(offsets))]
+            level += 1
+        return depth
+
+    # the row of a tax id, or -1 if there is no such taxon
+    def row(self, tax_id):
+        if 0 <= tax_id < len(self.rows):
+            return int(self.rows[tax_id])
+        return -1
+
+    # the rows with no parent
+    def roots(self):
+        return np.flatnonzero(self.parent < 0)
+
+    def name(self, row):
+        start = self.name_start[row]
+        return self.names[start:start + self.name_length[row]]
+
+    def kind_name(self, row):
+        return self.kinds[self.kind[row]]
+
+    def child_rows(self, row):
+        return self.children[self.child_start[row]:self.child_start[row + 1]]
+
+    # the rows from row up to its root, row first
+    def lineage(self, row):
+        parent = self.parent
+        res = []
+        while row >= 0:
+            res.append(row)
+            row = parent[row]
+        return res
+
+    # a Node tree of the taxon at row and its descendants, at most
+    # max_depth levels below it. Each node's id is its tax id
+    def subtree(self, row, max_depth=None):
+        root = self.make_node(row)
+        stack = [(root, row, 0)]
+        while stack:
+            node, row, depth = stack.pop()
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for child_row in self.child_rows(row).tolist():
+                child = self.make_node(child_row, node)
+                node.children.append(child)
+                stack.append((child, child_row, depth + 1))
+        return root
+
+    # a Node for the taxon at row whose parent chain runs up to its root,
+    # so that phylo.lineage can follow it. The nodes have no children
+    def node(self, row):
+        rows = self.lineage(row)
+        parent = None
+        for ancestor in reversed(rows):
+            parent = self.make_node(ancestor, parent)
+        return parent
+
+    def make_node(self, row, parent=None):
+        node = Node(self.name(row), self.kind_name(row), parent=parent)
+        node.id = int(self.tax_id[row])
+        return node
+
+
+# names are hashed as the sum of their bytes times powers of NAME_PRIME,
+# modulo 2 ** 64
+NAME_PRIME = 1099511628211
+MASK64 = (1 << 64) - 1
+
+def name_hash(name):
+    h, power = 0, 1
+    for c in bytearray(name):
+        h = (h + c * power) & MASK64
+        power = (power * NAME_PRIME) & MASK64
+    return np.uint64(h)
+
+# name_hash of each name names[start:start + length] at once, block_size
+# names at a time
+def name_hashes(names, start, length, block_size=1 << 18):
+    buf = np.frombuffer(names, dtype=np.uint8)
+    hashes = np.zeros(len(start), dtype=np.uint64)
+    powers = np.full(max(1, length.max() if len(length) else 1), NAME_PRIME, dtype=np.uint64)
+    powers[0] = 1
+    powers = np.cumprod(powers, dtype=np.uint64)
+    for first in xrange(0, len(start), block_size):
+        block_start = start[first:first + block_size]
+        block_length = length[first:first + block_size].astype(np.int64)
+        named = np.flatnonzero(block_length > 0)
+        ends = np.cumsum(block_length[named])
+        seg_start = ends - block_length[named]
+        place = np.arange(ends[-1] if len(ends) else 0) - np.repeat(seg_start, block_length[named])
+        chars = buf[np.repeat(block_start[named], block_length[named]) + place].astype(np.uint64)
+        if len(named):
+            hashes[first + named] = np.add.reduceat(chars * powers[place], seg_start)
+    return hashes
+
+
+# Lookup of taxa by scientific name. Exact names are found in a linear
+# probing hash table of rows (name_table, with -1 marking empty slots)
+# keyed by the names' hashes, so a lookup costs a hash and a probe or
+# two. Case-insensitive and prefix lookups binary search order, the named
+# rows sorted by lower-cased name. Where several taxa share a name, the
+# one with the lowest row comes first. All three arrays can be saved
+# with the taxonomy's cache
+class NameIndex(object):
+    columns = ('name_table', 'name_hash', 'name_order')
+
+    def __init__(self, tax, name_table=None, name_hash=None, name_order=None):
+        self.tax = tax
+        if name_hash is None:
+            name_hash = name_hashes(tax.names, tax.name_start, tax.name_length)
+        if name_table is None:
+            name_table = self.hash_table(name_hash, np.flatnonzero(tax.name_length > 0))
+        if name_order is None:
+            lower = str(tax.names).lower()
+            named = np.flatnonzero(tax.name_length > 0)
+            keys = [lower[start:start + length] for start, length in
+                    zip(tax.name_start[named].tolist(), tax.name_length[named].tolist())]
+            name_order = named[sorted(xrange(len(keys)), key=keys.__getitem__)].astype(np.int32)
+        self.name_table, self.name_hash, self.name_order = name_table, name_hash, name_order
+        # the hashed range is the largest power of two in the table
+        self.mask = (1 << (len(name_table) - 1).bit_length() - 1) - 1
+        self.lower_names = LowerNames(tax, name_order)
+
+    # a table more than twice as long as the number of rows, holding each
+    # row at the first free slot from the slot its hash picks. Placing the
+    # rows in order of that slot, each goes to the later of its own slot
+    # and the slot after the row before, which is a running maximum. Slots
+    # run on past the end of the hashed range rather than wrapping round,
+    # and of several equal names the lowest row comes first
+    @staticmethod
+    def hash_table(hashes, rows):
+        size = 1 << int(2 * len(rows)).bit_length()
+        home = (hashes[rows] & np.uint64(size - 1)).astype(np.int64)
+        order = np.argsort(home * (rows.max() + 1 if len(rows) else 1) + rows)
+        rank = np.arange(len(rows))
+        slot = np.maximum.accumulate(home[order] - rank) + rank
+        table = np.full(max(size + 1, slot[-1] + 2 if len(slot) else 0), -1, dtype=np.int32)
+        table[slot] = rows[order]
+        return table
+
+    # the rows of the taxa named exactly name, lowest first
+    def rows(self, name):
+        h = name_hash(name)
+        slot = int(h) & self.mask
+        res = []
+        while self.name_table[slot] >= 0:
+            row = int(self.name_table[slot])
+            if self.name_hash[row] == h and self.tax.name(row) == name:
+                res.append(row)
+            slot += 1
+        return res
+
+    # the row of the taxon named exactly name, or -1 if there is none
+    def row(self, name):
+        h = name_hash(name)
+        slot = int(h) & self.mask
+        while self.name_table[slot] >= 0:
+            row = int(self.name_table[slot])
+            if self.name_hash[row] == h and self.tax.name(row) == name:
+                return row
+            slot += 1
+        return -1
+
+    # the rows of the taxa named name, ignoring case
+    def rows_ignoring_case(self, name):
+        key = name.lower()
+        lo = bisect_left(self.lower_names, key)
+        hi = bisect_right(self.lower_names, key, lo)
+        return self.name_order[lo:hi]
+
+    # the rows of the taxa whose names start with prefix, ignoring case,
+    # in order of name. At most limit rows are returned if it is given
+    def rows_by_prefix(self, prefix, limit=None):
+        key = prefix.lower()
+        lo = bisect_left(self.lower_names, key)
+        hi = bisect_left(self.lower_names, key + '\xff', lo)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return self.name_order[lo:hi]
+
+# the lower-cased names of a taxonomy in the given order, as a sequence
+# that bisect can search without the names being copied out
+class LowerNames(object):
+    def __init__(self, tax, order):
+        self.tax, self.order = tax, order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        return self.tax.name(self.order[i]).lower()
+
+
+# Lowest common ancestor queries by binary lifting: up[k] holds the
+# ancestor 2 ** k levels above each row (roots are their own ancestors),
+# for k up to the log of the taxonomy's depth. A query lifts the deeper
+# row to the depth of the other, then lifts both by decreasing powers of
+# two while they differ, in O(log depth) array lookups. Every query is
+# made on arrays of rows, so a batch of pairs costs the same number of
+# vectorized steps as one pair
+class AncestorIndex(object):
+    def __init__(self, tax):
+        self.depth = tax.depths()
+        parent = np.where(tax.parent < 0, np.arange(len(tax)), tax.parent).astype(np.int32)
+        levels = max(1, int(np.ceil(np.log2(self.depth.max() + 1))) if len(tax) else 1)
+        self.up = np.empty((levels, len(tax)), dtype=np.int32)
+        self.up[0] = parent
+        for k in xrange(1, levels):
+            self.up[k] = self.up[k - 1][self.up[k - 1]]
+
+    # the row of the lowest common ancestor of rows a[i] and b[i] for each
+    # i, or -1 where the two have no common ancestor
+    def lca_rows(self, a, b):
+        a = np.array(a, dtype=np.int32, ndmin=1)
+        b = np.array(b, dtype=np.int32, ndmin=1)
+        swap = self.depth[a] < self.depth[b]
+        a[swap], b[swap] = b[swap], a[swap]
+
+        lift = self.depth[a] - self.depth[b]
+        for k in xrange(len(self.up)):
+            step = (lift >> k) & 1 == 1
+            a[step] = self.up[k][a[step]]
+        for k in reversed(xrange(len(self.up))):
+            up_a, up_b = self.up[k][a], self.up[k][b]
+            apart = up_a != up_b
+            a[apart], b[apart] = up_a[apart], up_b[apart]
+
+        res = np.where(a == b, a, self.up[0][a])
+        res[self.up[0][a] != self.up[0][b]] = -1
+        return res
+
+    # lca_rows for a single pair, stepping through the table one row at a
+    # time rather than paying for array operations on one element
+    def lca(self, a, b):
+        depth, up = self.depth, self.up
+        if depth[a] < depth[b]:
+            a, b = b, a
+        lift, k = depth[a] - depth[b], 0
+        while lift:
+            if lift & 1:
+                a = up[k, a]
+            lift >>= 1
+            k += 1
+        if a == b:
+            return int(a)
+        for k in reversed(xrange(len(up))):
+            if up[k, a] != up[k, b]:
+                a, b = up[k, a], up[k, b]
+        return int(up[0, a]) if up[0, a] == up[0, b] else -1
+
+    # the matrix of lowest common ancestors of every pair of the given rows
+    def lca_matrix(self, rows):
+        rows = np.asarray(rows, dtype=np.int32)
+        a, b = np.meshgrid(rows, rows, indexing='ij')
+        return self.lca_rows(a.ravel(), b.ravel()).reshape(len(rows), len(rows))
+
+
+# the taxonomy of the dumps at name_file_path and node_file_path, read
+# from the cache file at cache_path while the dumps are unchanged and
+# otherwise parsed from the dumps and cached for next time. With
+# index_names set the cache holds the name index as well
+def load_cached(name_file_path, node_file_path, cache_path, index_names=True):
+    sources = (name_file_path, node_file_path)
+    tax = Taxonomy.open(cache_path, sources)
+    if tax is None or (index_names and tax.name_index is None):
+        tax = Taxonomy.from_dumps(name_file_path, node_file_path)
+        if index_names:
+            tax.index_names()
+        tax.save(cache_path, sources)
+    return tax
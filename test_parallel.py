@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+import arrayfdl, flatbh, parallel
+
+# a random tree of n nodes as an ArrayGraph, with node 0 pinned
+def pinned_graph(n=200, seed=0):
+    random = np.random.RandomState(seed)
+    src = np.arange(1, n)
+    dst = (random.random_sample(n - 1) * src).astype(int)
+    graph = arrayfdl.ArrayGraph.from_arrays(random.randint(0, 500, (n, 2)), np.full(n, 300.),
+                                            src, dst)
+    graph.fixed[0] = True
+    return graph
+
+class ForcePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.serial, self.pooled = pinned_graph(), pinned_graph()
+        self.pool = parallel.ForcePool(self.pooled, 2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_coulomb_forces_match_with_pinned_node(self):
+        arrayfdl.update_forces(self.serial)
+        arrayfdl.update_forces(self.pooled)
+        np.testing.assert_allclose(self.pooled.force, self.serial.force)
+
+    def test_bh_forces_match_with_pinned_node(self):
+        flatbh.update_forces_bh(self.serial)
+        flatbh.update_forces_bh(self.pooled)
+        np.testing.assert_allclose(self.pooled.force, self.serial.force)
+
+    # the pinned node feels only its springs
+    def test_pinned_node_is_not_repelled(self):
+        flatbh.update_forces_bh(self.serial)
+        springs = pinned_graph()
+        arrayfdl.update_hooke_forces(springs)
+        np.testing.assert_allclose(self.serial.force[0], springs.force[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+from spatialgrid import SpatialGrid
+
+class SpatialGridTest(unittest.TestCase):
+    # the grid's answers for random queries against a plain scan
+    def check_queries(self, points, trials=100):
+        grid = SpatialGrid(points)
+        random = np.random.RandomState(0)
+        low, high = points.min(axis=0), points.max(axis=0)
+        for trial in xrange(trials):
+            x, y = low + random.random_sample(2) * (high - low)
+            left, top = x - 50, y - 50
+            right, bottom = x + 50, y + 50
+            inside = ((points[:, 0] >= left) & (points[:, 0] <= right) &
+                      (points[:, 1] >= top) & (points[:, 1] <= bottom))
+            self.assertEqual(grid.rect(left, top, right, bottom).tolist(),
+                             np.flatnonzero(inside).tolist())
+            dist = np.hypot(points[:, 0] - x, points[:, 1] - y)
+            self.assertEqual(sorted(grid.point(x, y, 30).tolist()),
+                             np.flatnonzero(dist <= 30).tolist())
+            self.assertEqual(dist[grid.nearest(x, y)], dist.min())
+        return grid
+
+    def test_random_points(self):
+        points = np.random.RandomState(1).random_sample((2000, 2)) * 700 + 100
+        self.check_queries(points)
+
+    def test_collinear_points(self):
+        points = np.zeros((1000, 2))
+        points[:, 0] = np.linspace(0, 1e6, 1000)
+        grid = self.check_queries(points)
+        self.assertLessEqual(grid.cols * grid.rows, 4 * len(points))
+
+    def test_far_outlier(self):
+        points = np.random.RandomState(2).random_sample((1000, 2)) * 700 + 100
+        points[0] = (1e6, 1e6)
+        grid = self.check_queries(points)
+        self.assertLessEqual(grid.cols * grid.rows, 4 * len(points))
+
+    def test_two_points_far_apart(self):
+        grid = SpatialGrid([(0, 0), (1e6, 0)])
+        self.assertLessEqual(len(grid.starts) - 1, 8)
+        self.assertEqual(grid.nearest(9e5, 0), 1)
+        self.assertEqual(grid.rect(-1, -1, 1, 1).tolist(), [0])
+
+    def test_empty(self):
+        grid = SpatialGrid(np.empty((0, 2)))
+        self.assertIsNone(grid.nearest(0, 0))
+        self.assertEqual(len(grid.rect(0, 0, 10, 10)), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,14 @@
 from unicodedata import normalize
+from collections import deque
+from itertools import izip, repeat
 
-# A minimal Node class used in constructing graphs
+# A minimal Node class used in constructing graphs. Nodes are slotted to
+# keep large trees small, so every attribute a node may carry (including
+# the simulation state set by fdl.initialize) is listed here
 class Node(object):
+    __slots__ = ('name', 'kind', 'parent', 'children', 'id',
+                 'pos', 'velocity', 'force', 'charge', 'fixed', 'screen_pos')
+
     def __init__(self, name="", kind="", children=None, parent=None):
         self.name   = name
         self.kind   = kind
@@ -14,8 +21,23 @@ class Node(object):
     def __repr__(self):
         return 'Node("{0}", "{1}")'.format(to_ascii(self.name), self.kind)
 
-# vector class used for force, position, and velocity. Pretty self explanatory
+    # slotted objects have no __dict__ for pickle to save, so the set
+    # attributes are passed explicitly. This also loads pickles of nodes
+    # saved before Node was slotted
+    def __getstate__(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__
+                    if hasattr(self, attr))
+
+    def __setstate__(self, state):
+        for attr, value in state.iteritems():
+            setattr(self, attr, value)
+
+# vector class used for force, position, and velocity. Pretty self explanatory.
+# The in-place operators update the vector itself rather than allocating
+# a new one
 class Vector(object):
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         self.x, self.y = x, y
     def length(self):
@@ -28,6 +50,22 @@ class Vector(object):
         return Vector(self.x * scalar, self.y * scalar)
     def __div__(self, scalar):
         return Vector(self.x / scalar, self.y / scalar)
+    def __iadd__(self, other):
+        self.x += other.x
+        self.y += other.y
+        return self
+    def __isub__(self, other):
+        self.x -= other.x
+        self.y -= other.y
+        return self
+    def __imul__(self, scalar):
+        self.x *= scalar
+        self.y *= scalar
+        return self
+    def __idiv__(self, scalar):
+        self.x /= scalar
+        self.y /= scalar
+        return self
     def __iter__(self):
         yield self.x
         yield self.y
@@ -45,6 +83,11 @@ class Vector(object):
             return Vector(0,0)
     def __repr__(self):
         return "({0}, {1})".format(self.x, self.y)
+    # pickled as Node is, so that pickles of unslotted Vectors still load
+    def __getstate__(self):
+        return {'x': self.x, 'y': self.y}
+    def __setstate__(self, state):
+        self.x, self.y = state['x'], state['y']
     __rmul__ = __mul__
 
 # Barnes-Hutt tree class for approximating the n-body problem
@@ -100,43 +143,176 @@ class BHTree:
             self.update_charge(body.charge, body.pos.x, body.pos.y)
 
 
-# simply inserts all the nodes in a nodelist into a BHTree
+# the centre and half-width of the smallest square containing every
+# point, never narrower than min_halfwidth
+def bounding_square(points, min_halfwidth=1):
+    xs, ys = zip(*points)
+    min_x, max_x, min_y, max_y = min(xs), max(xs), min(ys), max(ys)
+    halfwidth = max(max_x - min_x, max_y - min_y, 2 * min_halfwidth) / 2.0
+    return (min_x + max_x) / 2.0, (min_y + max_y) / 2.0, halfwidth
+
+# simply inserts all the nodes in a nodelist into a BHTree whose root
+# square is fitted to the current positions of the nodes
 def nodes_to_bh_tree(nodes):
-    root = BHTree(nodes[0], 500, 500, 500)
+    mid_x, mid_y, halfwidth = bounding_square([tuple(node.pos) for node in nodes])
+    root = BHTree(nodes[0], mid_x, mid_y, halfwidth)
     for node in nodes[1:]:
         root.insert(node)
     return root
 
+# Tree traversals. Each walks the tree with an explicit stack or queue
+# and yields nodes as it goes, so deep trees neither build intermediate
+# lists nor run into the recursion limit. max_depth, where taken, stops
+# the walk that many levels below the root (the root being at depth 0)
+
+# each node with its depth, parents before children, siblings in order
+def walk(root, max_depth=None):
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        yield node, depth
+        if node.children and (max_depth is None or depth < max_depth):
+            stack.extend(izip(reversed(node.children), repeat(depth + 1)))
+
+# each edge as (parent, child, depth of child), in pre-order of the child
+def walk_edges(root, max_depth=None):
+    stack = []
+    if max_depth is None or max_depth > 0:
+        stack = [(root, child, 1) for child in reversed(root.children)]
+    while stack:
+        parent, node, depth = stack.pop()
+        yield parent, node, depth
+        if node.children and (max_depth is None or depth < max_depth):
+            stack.extend(izip(repeat(node), reversed(node.children), repeat(depth + 1)))
+
+# each edge as (parent, child), in the order of walk_edges
+def iter_edges(root):
+    stack = [(root, child) for child in reversed(root.children)]
+    while stack:
+        edge = stack.pop()
+        yield edge
+        child = edge[1]
+        if child.children:
+            stack.extend(izip(repeat(child), reversed(child.children)))
+
+def preorder(root, max_depth=None):
+    if max_depth is not None:
+        for node, depth in walk(root, max_depth):
+            yield node
+        return
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+# children before parents
+def postorder(root, max_depth=None):
+    stack = [(root, 0, False)]
+    while stack:
+        node, depth, expanded = stack.pop()
+        if expanded or (max_depth is not None and depth >= max_depth) or not node.children:
+            yield node
+        else:
+            stack.append((node, depth, True))
+            stack.extend(izip(reversed(node.children), repeat(depth + 1), repeat(False)))
+
+# breadth first, a level at a time
+def level_order(root, max_depth=None):
+    queue = deque([(root, 0)])
+    while queue:
+        node, depth = queue.popleft()
+        yield node
+        if node.children and (max_depth is None or depth < max_depth):
+            queue.extend(izip(node.children, repeat(depth + 1)))
+
+# the nodes below the root with no children, in pre-order
+def iter_leaves(root):
+    for node in preorder(root):
+        if not node.children and node is not root:
+            yield node
+
+# A view of the top of a tree, cut off max_depth levels below the root
+# and/or at every node for which predicate(node) is false (whose whole
+# subtree is then left out), without copying anything. Its nodes are the
+# tree's own Node objects, and everything is worked out as it is walked,
+# so a view costs time in proportion to the nodes it shows. Iterating
+# over a view yields its nodes in pre-order, so it can be passed to
+# fdl.initialize and fdl.run_simulation in place of a list of nodes
+class TreeView(object):
+    def __init__(self, root, max_depth=None, predicate=None):
+        self.root, self.max_depth, self.predicate = root, max_depth, predicate
+        self.depth = None
+
+    # the same tree cut off at another depth
+    def with_depth(self, max_depth):
+        return TreeView(self.root, max_depth, self.predicate)
+
+    # the children of a node that the view shows, or none if the node is
+    # at the view's depth limit
+    def children(self, node, depth=None):
+        if depth is None:
+            if self.depth is None:
+                self.depth = dict(self.walk())
+            depth = self.depth[node]
+        if self.max_depth is not None and depth >= self.max_depth:
+            return []
+        if self.predicate is None:
+            return node.children
+        return [child for child in node.children if self.predicate(child)]
+
+    # as treeclasses.walk and walk_edges, over the nodes of the view
+    def walk(self):
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            children = self.children(node, depth)
+            if children:
+                stack.extend(izip(reversed(children), repeat(depth + 1)))
+
+    def walk_edges(self):
+        stack = [(self.root, child, 1) for child in reversed(self.children(self.root, 0))]
+        while stack:
+            parent, node, depth = stack.pop()
+            yield parent, node, depth
+            children = self.children(node, depth)
+            if children:
+                stack.extend(izip(repeat(node), reversed(children), repeat(depth + 1)))
+
+    def __iter__(self):
+        for node, depth in self.walk():
+            yield node
+
+    def nodes(self):
+        return list(self)
+
+    # the edges of the view as (parent, child) in the order of get_edges
+    def edges(self):
+        return [(parent, child) for parent, child, depth in self.walk_edges()]
+
+    # the nodes below the root with no children in the view, in pre-order
+    def leaves(self):
+        return [node for node, depth in self.walk()
+                if depth > 0 and not self.children(node, depth)]
+
+
 # return a tree, trimmed after a certain level
 def pruned(root, level):
-    new_root = Node()
-    new_root.name = root.name
-    new_root.kind = root.kind
-    new_root.children = []
-
-    if level == 0:
-        return new_root
-    else:
-        for child in root.children:
-            new_root.children.append(pruned(child, level - 1))
-        return new_root
+    new_root = Node(root.name, root.kind)
+    copies = {root: new_root}
+    for parent, node, depth in walk_edges(root, level):
+        copy = copies[node] = Node(node.name, node.kind)
+        copies[parent].children.append(copy)
+    return new_root
 
 # return the leaves of a root
 def leaves(root):
-    res = []
-    for child in root.children:
-        if child.children == []:
-            res.append(child)
-        else:
-            res.extend(leaves(child))
-    return res
+    return list(iter_leaves(root))
 
 # return all the nodes in a tree
 def all_nodes(root):
-    res = [root]
-    for child in root.children:
-        res.extend(all_nodes(child))
-    return res
+    return list(preorder(root))
 
 
 # converts a unicode string to an ascii approximation
@@ -147,11 +323,7 @@ def to_ascii(u):
         return u
 
 def get_edges(root):
-    edges = []
-    for child in root.children:
-        edges.append((root, child))
-        edges.extend(get_edges(child))
-    return edges
+    return list(iter_edges(root))
 
 def binary_tree(level):
     if level == 0:
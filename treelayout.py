@@ -0,0 +1,184 @@
+from math import pi
+from itertools import izip, repeat
+import numpy as np
+from fdl import *
+import arrayfdl
+
+# Tidy drawings of trees in linear time, following Walker's algorithm as
+# improved by Buchheim, Junger and Leipert: parents are centred over their
+# children, subtrees are packed as closely as their contours allow, and
+# identical subtrees are drawn identically. Both walks of the tree are
+# iterative, so deep trees do not hit the recursion limit. The root may
+# also be a TreeView, in which case only the nodes of the view are placed
+
+# the nodes of a tree in pre-order, with the depth, parent and children of
+# each as indices into that order (the root's parent is -1)
+def index_tree(root):
+    view = root if isinstance(root, TreeView) else None
+    nodes, depth, parent, children = [], [], [], []
+    stack = [((view.root if view else root), -1)]
+    while stack:
+        node, p = stack.pop()
+        i = len(nodes)
+        nodes.append(node)
+        parent.append(p)
+        children.append([])
+        if p >= 0:
+            children[p].append(i)
+            depth.append(depth[p] + 1)
+        else:
+            depth.append(0)
+        kids = view.children(node, depth[i]) if view else node.children
+        if kids:
+            stack.extend(izip(reversed(kids), repeat(i)))
+    return nodes, depth, parent, children
+
+# the x coordinate of every node of a tree with neighbouring nodes at
+# least distance apart, along with the nodes in pre-order and their
+# depths. The root is at x = 0
+def tidy_positions(root, distance=1.0):
+    nodes, depth, parent, children = index_tree(root)
+    n = len(nodes)
+    prelim, mod = [0.0] * n, [0.0] * n
+    shift, change = [0.0] * n, [0.0] * n
+    thread, ancestor = [-1] * n, range(n)
+    # each node's position among its siblings, and its left sibling
+    number, left = [0] * n, [-1] * n
+    for kids in children:
+        for k, w in enumerate(kids):
+            number[w] = k
+            if k:
+                left[w] = kids[k - 1]
+
+    def next_left(v):
+        return children[v][0] if children[v] else thread[v]
+
+    def next_right(v):
+        return children[v][-1] if children[v] else thread[v]
+
+    def move_subtree(wl, wr, amount):
+        subtrees = float(number[wr] - number[wl])
+        change[wr] -= amount / subtrees
+        shift[wr]  += amount
+        change[wl] += amount / subtrees
+        prelim[wr] += amount
+        mod[wr]    += amount
+
+    # separate the subtree of v from those of its left siblings, returning
+    # the new default ancestor
+    def apportion(v, default_ancestor):
+        w = left[v]
+        if w < 0:
+            return default_ancestor
+        vir = vor = v
+        vil, vol = w, children[parent[v]][0]
+        sir = sor = mod[vir]
+        sil, sol = mod[vil], mod[vol]
+        while next_right(vil) >= 0 and next_left(vir) >= 0:
+            vil, vir = next_right(vil), next_left(vir)
+            vol, vor = next_left(vol), next_right(vor)
+            ancestor[vor] = v
+            amount = (prelim[vil] + sil) - (prelim[vir] + sir) + distance
+            if amount > 0:
+                a = ancestor[vil]
+                move_subtree(a if parent[a] == parent[v] else default_ancestor, v, amount)
+                sir += amount
+                sor += amount
+            sil += mod[vil]
+            sir += mod[vir]
+            sol += mod[vol]
+            sor += mod[vor]
+        if next_right(vil) >= 0 and next_right(vor) < 0:
+            thread[vor] = next_right(vil)
+            mod[vor] += sil - sor
+        if next_left(vir) >= 0 and next_left(vol) < 0:
+            thread[vol] = next_left(vir)
+            mod[vol] += sir - sol
+            default_ancestor = v
+        return default_ancestor
+
+    # the first walk, children before parents. Each node is apportioned
+    # against its left siblings as soon as its own subtree is done
+    default_ancestor = [kids[0] if kids else -1 for kids in children]
+    for v in reversed(postorder_indices(children)):
+        kids = children[v]
+        if kids:
+            total_shift = total_change = 0.0
+            for w in reversed(kids):
+                prelim[w] += total_shift
+                mod[w]    += total_shift
+                total_change += change[w]
+                total_shift  += shift[w] + total_change
+            midpoint = (prelim[kids[0]] + prelim[kids[-1]]) / 2.0
+            if left[v] >= 0:
+                prelim[v] = prelim[left[v]] + distance
+                mod[v] = prelim[v] - midpoint
+            else:
+                prelim[v] = midpoint
+        elif left[v] >= 0:
+            prelim[v] = prelim[left[v]] + distance
+        if parent[v] >= 0:
+            default_ancestor[parent[v]] = apportion(v, default_ancestor[parent[v]])
+
+    # the second walk, parents before children, adding up the modifiers
+    x = [0.0] * n
+    offset = [0.0] * n
+    offset[0] = -prelim[0]
+    for v in xrange(n):
+        x[v] = prelim[v] + offset[v]
+        for w in children[v]:
+            offset[w] = offset[v] + mod[v]
+    return nodes, x, depth
+
+# the indices of a tree's nodes in reverse post-order, given the children
+# of each in pre-order numbering
+def postorder_indices(children):
+    order, stack = [], [0]
+    while stack:
+        v = stack.pop()
+        order.append(v)
+        stack.extend(children[v])
+    return order
+
+# set the pos of each node to whole-pixel coordinates, returning them as
+# a list of (x, y) tuples
+def place(nodes, x, y):
+    points = zip(arrayfdl.round_half_away(x).astype(int).tolist(),
+                 arrayfdl.round_half_away(y).astype(int).tolist())
+    for node, (px, py) in izip(nodes, points):
+        node.pos = Vector(px, py)
+    return points
+
+# set each node's pos to a tidy drawing of the tree fitting in width by
+# height, the root at the top. Returns the positions as a list of (x, y)
+# tuples in pre-order
+def tidy_layout(root, width=500, height=500):
+    nodes, x, depth = tidy_positions(root)
+    x, depth = np.array(x), np.array(depth, dtype=float)
+    x -= x.min()
+    return place(nodes, x * (width / max(x.max(), 1.0)), depth * (height / max(depth.max(), 1.0)))
+
+# set each node's pos to a radial drawing of the tree within a circle of
+# the given radius about (radius, radius): each level is a ring, and the
+# tidy x order runs once around the circle, leaving a gap between its two
+# ends. Returns the positions as tidy_layout does
+def radial_layout(root, radius=250):
+    nodes, x, depth = tidy_positions(root)
+    x, depth = np.array(x), np.array(depth, dtype=float)
+    x -= x.min()
+    angle = x * (2 * pi / (x.max() + 1))
+    ring = depth * (radius / max(depth.max(), 1.0))
+    return place(nodes, radius + ring * np.cos(angle), radius + ring * np.sin(angle))
+
+# initialize the nodes of a tree as fdl.initialize does, but starting
+# from a tidy (or radial) drawing rather than random positions, so that a
+# short force simulation is enough to refine it. Returns the nodes in
+# pre-order
+def seed_tree(root, width, charge, radial=False):
+    nodes = list(root) if isinstance(root, TreeView) else all_nodes(root)
+    initialize(nodes, width, charge)
+    if radial:
+        radial_layout(root, width / 2.0)
+    else:
+        tidy_layout(root, width, width)
+    return nodes